@@ -12,16 +12,23 @@
 # --------------------------------------------------------------------
 
 import logging
-logger = logging.basicConfig(level=logging.WARN)
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+# the scraper only logs problems, but this script's summaries are wanted
+logger.setLevel(logging.INFO)
 
 from bmscraper import BMScraper, AndroidEmotesProcessorFactory
-from bmscraper.ratelimiter import TokenBucket
+from bmscraper.ratelimiter import AdaptiveRateLimiter
+from bmscraper.outputwriter import write_gzip
+from bmscraper.imagebundle import bundle_subreddit
 from data import *
 from json import dumps
 import os
-import gzip
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-factory = AndroidEmotesProcessorFactory(single_emotes_filename=os.path.join( '..', 'single_emotes', '{}', '{}.png'))
+factory = AndroidEmotesProcessorFactory(single_emotes_filename=os.path.join( '..', 'single_emotes', '{}', '{}.png'),
+                                        encoder_profile=os.environ.get('EMOTE_ENCODER_PROFILE'))
 scraper = BMScraper(factory)
 scraper.user = os.environ['REDDIT_USERNAME']
 scraper.password = os.environ['REDDIT_PASSWORD']
@@ -30,33 +37,37 @@ scraper.legacy_subreddits = legacy_subreddits
 scraper.image_blacklist = image_blacklist_android
 scraper.nsfw_subreddits = nsfw_subreddits
 scraper.emote_info = emote_info
-scraper.rate_limit_lock = TokenBucket(1, 6)
+scraper.incremental = True
+scraper.rate_limit_lock = AdaptiveRateLimiter(1, 6)
 
 scraper.scrape()
 
-f = gzip.open(os.path.join('..', 'single_emotes', 'emotes.json.gz'), 'wb')
-f.write(dumps(factory.emotes, separators=(',', ': ')).encode('utf-8'))
-f.close()
+def write_emotes(path, emotes):
+    return write_gzip(path, dumps(emotes, separators=(',', ': ')).encode('utf-8'))
 
+subreddit_emotes = defaultdict(list)
+for emote in factory.emotes:
+    subreddit_emotes[emote['sr']].append(emote)
+
+# optionally pack each subreddit's images into one file the app can get in a single request
+if os.environ.get('EMOTE_BUNDLES'):
+    bundled_subreddits = [subreddit for subreddit in subreddits if subreddit_emotes[subreddit]]
+    with ThreadPoolExecutor() as pool:
+        bundled = sum(pool.map(lambda subreddit: bundle_subreddit(os.path.join('..', 'single_emotes'), subreddit,
+                                                                  subreddit_emotes[subreddit], factory.hashes),
+                               bundled_subreddits))
+    factory.hashes.save()
+    logger.info('Wrote {} of {} image bundles, the others are unchanged'.format(bundled, len(bundled_subreddits)))
+
+# processors finish in any order, sorted so an unchanged scrape gives the same file
+outputs = [(os.path.join('..', 'single_emotes', 'emotes.json.gz'),
+            sorted(factory.emotes, key=lambda x: (x['sr'], x['image']))),
+           (os.path.join('..', 'single_emotes', 'subreddits.json.gz'), subreddits)]
 for subreddit in subreddits:
-    subreddit_emotes = [x for x in factory.emotes if x['sr'] == subreddit]
-    subreddit_emotes = sorted(subreddit_emotes, key = lambda x: x['image'])
-    emotes_file = os.path.join('..', 'single_emotes', subreddit, 'emotes.json.gz')
-    if not os.path.exists(os.path.dirname(emotes_file)):
-        os.makedirs(os.path.dirname(emotes_file))
-
-    emotes_data = dumps(subreddit_emotes, separators=(',', ': '))
-    emotes_data_old = ''
-    if (os.path.exists(emotes_file)):
-        f = gzip.open(emotes_file, 'r')
-        emotes_data_old = f.read()
-        f.close()
-
-    if emotes_data != emotes_data_old:
-        f = gzip.open(emotes_file, 'wb')
-        f.write(emotes_data.encode('utf-8'))
-        f.close()
-
-f = gzip.open(os.path.join('..', 'single_emotes', 'subreddits.json.gz'), 'wb')
-f.write(dumps(subreddits, separators=(',', ': ')).encode('utf-8'))
-f.close()
+    outputs.append((os.path.join('..', 'single_emotes', subreddit, 'emotes.json.gz'),
+                    sorted(subreddit_emotes[subreddit], key=lambda x: x['image'])))
+
+# files are only replaced when their content changed, so the app's conditional requests keep hitting
+with ThreadPoolExecutor() as pool:
+    written = sum(pool.map(lambda output: write_emotes(*output), outputs))
+logger.info('Wrote {} of {} emote files, the others are unchanged'.format(written, len(outputs)))
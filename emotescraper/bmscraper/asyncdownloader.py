@@ -0,0 +1,180 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .retryscheduler import backoff_delay, RetryBudget
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse(object):
+    """
+    The subset of requests.Response the download callbacks rely on.
+
+    A streamed response has no content, iter_content() pulls the body from
+    the event loop while the callback runs on a worker thread.
+    """
+
+    def __init__(self, status_code, url, headers, content=None, encoding=None, reader=None, history=()):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        # the redirects that led here, as AsyncResponses without a body
+        self.history = list(history)
+        self.content = content
+        self.encoding = encoding
+        self._reader = reader
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def iter_content(self, chunk_size=1):
+        if self.content is not None:
+            for offset in range(0, len(self.content), chunk_size):
+                yield self.content[offset:offset + chunk_size]
+            return
+
+        while True:
+            chunk = self._reader(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __bool__(self):
+        return self.status_code < 400
+
+
+class AsyncDownloader(object):
+    """
+    Runs DownloadJobs on a single asyncio event loop thread, with at most
+    max_in_flight requests open at the same time. Callbacks are handed to a
+    thread pool so parsing and disk I/O don't stall the loop.
+    """
+
+    def __init__(self, headers=None, cookies=None, max_in_flight=64, callback_workers=None, retry_budget=None):
+        if aiohttp is None:
+            raise RuntimeError('The asyncio fetch engine requires aiohttp')
+
+        self.headers = headers
+        self.cookies = cookies
+        self.max_in_flight = max_in_flight
+        self.callback_workers = callback_workers
+        self.retry_budget = retry_budget or RetryBudget()
+        self._thread = None
+
+    def start(self, jobs):
+        self._thread = threading.Thread(target=self.run, args=(list(jobs),))
+        self._thread.start()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run(self, jobs):
+        asyncio.run(self._run(jobs))
+
+    async def _run(self, jobs):
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        # TokenBucket.acquire() sleeps, keep it off the loop and out of the callback pool
+        limiter_executor = ThreadPoolExecutor(1)
+        callback_executor = ThreadPoolExecutor(self.callback_workers)
+        try:
+            async with aiohttp.ClientSession(headers=self.headers) as session:
+                for cookie in self.cookies or []:
+                    response_url = URL('https://{}/'.format(cookie.domain.lstrip('.'))) if cookie.domain else None
+                    session.cookie_jar.update_cookies({cookie.name: cookie.value}, response_url)
+                await asyncio.gather(*[self._run_job(session, semaphore, limiter_executor, callback_executor, job)
+                                       for job in jobs])
+        finally:
+            limiter_executor.shutdown()
+            callback_executor.shutdown()
+
+    async def _run_job(self, session, semaphore, limiter_executor, callback_executor, job):
+        loop = asyncio.get_running_loop()
+        callback = partial(job.callback, **job.callbackargs) if job.callback else None
+        try:
+            response = None
+
+            while job.retry > 0:
+                job.retry -= 1
+                job.attempts += 1
+                if job.rate_limit_lock:
+                    await loop.run_in_executor(limiter_executor, job.rate_limit_lock.acquire)
+
+                async with semaphore:
+                    raw_response = None
+                    try:
+                        raw_response = await self._open(session, job.url, job.headers)
+                        response = await self._read_response(loop, raw_response, job.stream)
+                        job.rate_limit_lock and job.rate_limit_lock.update(response)
+                    except Exception as e:
+                        logger.exception(e)
+                        response = None
+
+                    try:
+                        if job.is_complete(response):
+                            # a streamed body is read by the callback, keep the connection until it is done
+                            if callback:
+                                await loop.run_in_executor(callback_executor, callback, response)
+                            return
+                    finally:
+                        if raw_response is not None:
+                            raw_response.release()
+
+                if job.retry <= 0:
+                    break
+                if not self.retry_budget.take():
+                    logger.warn("Error loading {}, retry budget is used up".format(job.url))
+                    break
+                # the in-flight slot is free while the job waits for its retry
+                delay = backoff_delay(job.attempts)
+                logger.warn("Error loading {}, retrying {} more times in {:.1f}s".format(job.url, job.retry, delay))
+                await asyncio.sleep(delay)
+
+            logger.warn("Error loading {}, giving up".format(job.url))
+            if callback:
+                await loop.run_in_executor(callback_executor, callback, response)
+        except Exception as e:
+            logger.exception(e)
+
+    async def _open(self, session, url, headers=None):
+        response = await session.get(url, headers=headers)
+        if "over18" in str(response.url):
+            response.release()
+            response = await session.post(response.url, data={"over18": "yes"})
+        return response
+
+    async def _read_response(self, loop, response, stream=False):
+        history = [AsyncResponse(r.status, str(r.url), r.headers) for r in response.history]
+        if stream:
+            def reader(size):
+                return asyncio.run_coroutine_threadsafe(response.content.read(size), loop).result()
+
+            return AsyncResponse(response.status, str(response.url), response.headers, reader=reader, history=history)
+
+        content = await response.read()
+        try:
+            encoding = response.get_encoding()
+        except RuntimeError:
+            encoding = None
+        return AsyncResponse(response.status, str(response.url), response.headers, content, encoding, history=history)
@@ -0,0 +1,121 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path, chunk_size=64 * 1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class BlobStore(object):
+    """
+    Content addressed image cache. Every distinct image is stored once as
+    {root}/{digest[:2]}/{digest}, index.json maps image urls to digests so
+    the same sprite sheet under another url or in another subreddit is
+    downloaded, stored and processed only once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+        self._index = {}
+        self._lock = threading.RLock()
+
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf8') as f:
+                    self._index = json.load(f)
+            except ValueError:
+                logger.error("Image index {} is broken, starting over".format(self.index_path))
+
+    def get_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get_digest(self, url):
+        """
+        Digest of the image behind url, None if it isn't in the store.
+        """
+        with self._lock:
+            digest = self._index.get(url)
+        if digest and os.path.isfile(self.get_path(digest)):
+            return digest
+        return None
+
+    def new_temp_file(self):
+        if not os.path.exists(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                pass
+        return tempfile.mkstemp(dir=self.root, suffix='.part')
+
+    def add(self, url, temp_path, digest):
+        """
+        Moves a finished temp file into the store, or drops it if the same
+        content is already there.
+        """
+        blob_path = self.get_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+        else:
+            if not os.path.exists(os.path.dirname(blob_path)):
+                try:
+                    os.makedirs(os.path.dirname(blob_path))
+                except OSError:
+                    pass
+            # mkstemp creates the file private
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, blob_path)
+
+        with self._lock:
+            self._index[url] = digest
+
+    def import_file(self, url, path):
+        """
+        Adds an image that was downloaded before the store existed.
+        """
+        digest = hash_file(path)
+        blob_path = self.get_path(digest)
+        if not os.path.exists(blob_path):
+            fd, temp_path = self.new_temp_file()
+            os.close(fd)
+            try:
+                os.remove(temp_path)
+                os.link(path, temp_path)
+            except OSError:
+                shutil.copyfile(path, temp_path)
+            self.add(url, temp_path, digest)
+        else:
+            with self._lock:
+                self._index[url] = digest
+        return digest
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._index, separators=(',', ':'), sort_keys=True)
+
+        fd, temp_path = self.new_temp_file()
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(data)
+        os.replace(temp_path, self.index_path)
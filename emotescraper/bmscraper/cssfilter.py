@@ -0,0 +1,77 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import re
+from tinycss.token_data import COMPILED_TOKEN_REGEXPS
+
+# Reuse tinycss' own patterns for every token that can hide a brace, so rule
+# boundaries end up exactly where tinycss would put them.
+_TOKEN_PATTERNS = dict((name, match.__self__.pattern) for name, match in COMPILED_TOKEN_REGEXPS)
+
+_STRUCTURE = re.compile(r'''
+    [^/"'uU\\{{}}()\[\];]+
+    |{COMMENT}|{BAD_COMMENT}
+    |{STRING}|{BAD_STRING}
+    |(?<![-\w\\]){URI}|(?<![-\w\\]){BAD_URI}
+    |\\[^\n\r\f]
+    |(?P<char>[{{}}()\[\];])
+'''.format(**_TOKEN_PATTERNS), re.I | re.X)
+
+# What parse_rules() skips before deciding between an at-rule and a ruleset
+_RULE_START = re.compile(r'(?:[ \t\r\n\f]+|{COMMENT}|{BAD_COMMENT}|<!--|-->)*'.format(**_TOKEN_PATTERNS), re.I)
+_AT_KEYWORD = re.compile(_TOKEN_PATTERNS['ATKEYWORD'], re.I)
+
+_CLOSING = {'{': '}', '(': ')', '[': ']'}
+
+
+def _is_at_rule(css, start):
+    return _AT_KEYWORD.match(css, _RULE_START.match(css, start).end()) is not None
+
+
+def extract_emote_rules(css):
+    """
+    Cuts a stylesheet down to the rulesets whose selector mentions href, which
+    is all parse_css() looks at. Scanning for rule boundaries is a lot cheaper
+    than having tinycss tokenize and parse the layout css around the emotes.
+
+    At-rules are dropped entirely, parse_css() can't handle them anyway.
+    """
+    rules = []
+    stack = []
+    rule_start = 0
+    block_start = None
+
+    for match in _STRUCTURE.finditer(css):
+        char = match.group('char')
+        if not char:
+            continue
+
+        if char in _CLOSING:
+            if not stack and char == '{':
+                block_start = match.start()
+            stack.append(char)
+        elif char == ';':
+            # only an at-rule ends on a ';', a ruleset keeps it as part of its selector
+            if not stack and _is_at_rule(css, rule_start):
+                rule_start = match.end()
+        elif stack and char == _CLOSING[stack[-1]]:
+            # unmatched closing characters don't close anything
+            stack.pop()
+            if not stack and block_start is not None:
+                if 'href' in css[rule_start:block_start] and not _is_at_rule(css, rule_start):
+                    rules.append(css[rule_start:match.end()])
+                rule_start = match.end()
+                block_start = None
+
+    # a block still open at the end of the stylesheet is closed implicitly
+    if block_start is not None and 'href' in css[rule_start:block_start] and not _is_at_rule(css, rule_start):
+        rules.append(css[rule_start:])
+
+    return ''.join(rules)
@@ -12,6 +12,7 @@
 
 from workerpool import Job
 from time import sleep
+from .retryscheduler import backoff_delay
 
 import logging
 
@@ -19,38 +20,69 @@ logger = logging.getLogger(__name__)
 
 
 class DownloadJob(Job):
-    def __init__(self, requests, url, retry=1, rate_limit_lock=None, callback=None, **callbackargs):
+    def __init__(self, requests, url, retry=1, rate_limit_lock=None, callback=None, headers=None,
+                 stream=False, scheduler=None, **callbackargs):
         super(DownloadJob, self).__init__()
-        self._url = url
+        self.url = url
         self._requests = requests
+        self.headers = headers
+        # a streamed body is left for the callback to read with iter_content()
+        self.stream = stream
+        # failed attempts are handed to the scheduler instead of sleeping in the worker
+        self.scheduler = scheduler
 
-        self._callback = callback
-        self._callbackargs = callbackargs
-        self._retry = retry
+        self.callback = callback
+        self.callbackargs = callbackargs
+        self.retry = retry
+        self.attempts = 0
         self.rate_limit_lock = rate_limit_lock
 
+    def is_complete(self, response):
+        # 304 Not Modified answers a conditional request, there is nothing to retry
+        return response is not None and response.status_code in (200, 304)
+
+    def _attempt(self):
+        self.retry -= 1
+        self.attempts += 1
+        try:
+            self.rate_limit_lock and self.rate_limit_lock.acquire()
+            response = self._requests.get(self.url, headers=self.headers, stream=self.stream)
+            if ("over18" in response.url):
+                response.close()
+                response = self._requests.post(response.url, {"over18": "yes"}, stream=self.stream)
+            self.rate_limit_lock and self.rate_limit_lock.update(response)
+            return response
+        except Exception as e:
+            logger.exception(e)
+            return None
+
     def run(self):
         try:
-            response = None
-
-            while (not response or response.status_code != 200) and self._retry > 0:
-                backoff = 0
-                try:
-                    self._retry -= 1
-                    self.rate_limit_lock and self.rate_limit_lock.acquire()
-                    response = self._requests.get(self._url)
-                    if ("over18" in response.url):
-                        response = self._requests.post(response.url, {"over18": "yes"})
-                except Exception as e:
-                    logger.exception(e)
-                    response = None
-                finally:
-                    if not response or response.status_code != 200:
-                        logger.warn("Error loading {}, retrying {} more times".format(self._url, self._retry))
-                        backoff += 10
-                        sleep(backoff)
-
-            if self._callback:
-                self._callback(response, **self._callbackargs)
+            while True:
+                response = self._attempt()
+                if self.is_complete(response) or self.retry <= 0:
+                    break
+
+                response is not None and response.close()
+                delay = backoff_delay(self.attempts)
+                if self.scheduler:
+                    if self.scheduler.schedule(self, delay):
+                        logger.warn("Error loading {}, retrying {} more times in {:.1f}s".format(
+                            self.url, self.retry, delay))
+                        return
+                    logger.warn("Error loading {}, retry budget is used up".format(self.url))
+                    break
+
+                logger.warn("Error loading {}, retrying {} more times in {:.1f}s".format(self.url, self.retry, delay))
+                sleep(delay)
+
+            if not self.is_complete(response):
+                logger.warn("Error loading {}, giving up".format(self.url))
+
+            try:
+                if self.callback:
+                    self.callback(response, **self.callbackargs)
+            finally:
+                response is not None and response.close()
         except Exception as e:
-            logger.exception(e)
\ No newline at end of file
+            logger.exception(e)
@@ -15,12 +15,31 @@ from workerpool import Job
 import logging
 logger = logging.getLogger(__name__) 
 
+def process_in_worker(processor):
+    """
+    Runs a processor in a pool process and returns what its merge_result() needs back in the scraper's.
+    """
+    processor.run()
+    return processor.get_result()
+
+
 class AbstractEmotesProcessorFactory(object):
     def __init__(self):
         pass
     
     def new_processor(self, scraper=None, image_url=None, group=None):
         raise NotImplementedError()
+
+    def get_state(self, subreddit):
+        # Whatever the factory collected for a subreddit besides the emotes, kept for incremental scrapes
+        return None
+
+    def restore_state(self, subreddit, state):
+        pass
+
+    def finish(self):
+        # called once all processors of a scrape are done
+        pass
     
 class AbstractEmotesProcessor(Job):
     def __init__(self, scraper=None, image_url=None, group=None):
@@ -28,12 +47,32 @@ class AbstractEmotesProcessor(Job):
         self.scraper = scraper
         self.image_url = image_url
         self.group = group
+        # whether process_group() went through, emotes of a failed group aren't kept for incremental scrapes
+        self.completed = False
+
+    def __getstate__(self):
+        # the scraper doesn't pickle, a processor sent to another process gets just what it uses of it
+        state = self.__dict__.copy()
+        state['scraper'] = self.scraper.get_processor_context(self.image_url)
+        return state
+
+    def get_result(self):
+        # the emotes as processed in another process, merge_result() applies them to the originals
+        return {'group': self.group, 'completed': self.completed}
+
+    def merge_result(self, result):
+        with self.scraper.mutex:
+            for emote, processed in zip(self.group, result['group']):
+                emote.clear()
+                emote.update(processed)
+        self.completed = result['completed']
     
     def run(self):
         try:
             logger.debug('Processing {}'.format(self.image_url))
                         
             self.process_group()
+            self.completed = True
         except Exception as e:
             logger.exception(e)
         
@@ -10,12 +10,11 @@
 #
 # --------------------------------------------------------------------
 
+from .abstract_emotes_processor import AbstractEmotesProcessor
 from .basic_emotes_processor import BasicEmotesProcessorFactory, BasicEmotesProcessor
 from .apngcheck import APNGCheck
+from ..hashmanifest import HashManifest, hash_bytes
 import os
-from subprocess import check_call
-from shutil import copyfile
-from glob import glob
 from PIL import Image
 import hashlib
 from io import StringIO, BytesIO
@@ -47,90 +46,108 @@ class AndroidEmotesProcessorFactory(BasicEmotesProcessorFactory):
     def __init__(self, 
                  single_emotes_filename=os.path.join('single_emotes', '{}', '{}.png'),
                  apng_dir='images', 
-                 apng_url='images/{}/{}'):
-        BasicEmotesProcessorFactory.__init__(self, single_emotes_filename=single_emotes_filename)
+                 apng_url='images/{}/{}',
+                 encoder_profile=None,
+                 hash_manifest=None):
+        BasicEmotesProcessorFactory.__init__(self,
+                                             single_emotes_filename=single_emotes_filename,
+                                             encoder_profile=encoder_profile)
         self.emotes = []
         self.singe_emotes_filename_apng = os.path.dirname(self.single_emotes_filename) + os.path.sep + '{}_frame_{:0>3}.png'
+        # hashes of the single emote files, by default next to the subreddit folders
+        if hash_manifest is None:
+            hash_manifest = os.path.join(os.path.dirname(os.path.dirname(self.single_emotes_filename)), '.hashes.json')
+        self.hashes = HashManifest(hash_manifest)
         
+    def get_state(self, subreddit):
+        return [e for e in self.emotes if e['sr'] == subreddit]
+
+    def restore_state(self, subreddit, state):
+        self.emotes.extend(state or [])
+
+    def finish(self):
+        self.hashes.save()
+
     def new_processor(self, scraper=None, image_url=None, group=None):
         return  AndroidEmotesProcessor(scraper=scraper,
                                           image_url=image_url,
                                           group=group,
                                           single_emotes_filename=self.single_emotes_filename,
                                           emotes=self.emotes,
-                                          single_emotes_filename_apng=self.singe_emotes_filename_apng)
+                                          single_emotes_filename_apng=self.singe_emotes_filename_apng,
+                                          encoder_profile=self.encoder_profile,
+                                          hashes=self.hashes)
         
         
 class AndroidEmotesProcessor(BasicEmotesProcessor, APNGCheck):
-    def __init__(self, scraper=None, image_url=None, group=None, single_emotes_filename=None, emotes=None, single_emotes_filename_apng=None):
+    def __init__(self, scraper=None, image_url=None, group=None, single_emotes_filename=None, emotes=None, single_emotes_filename_apng=None,
+                 encoder_profile=None, hashes=None):
         BasicEmotesProcessor.__init__(self,
                                          scraper=scraper,
                                          image_url=image_url,
                                          group=group,
-                                         single_emotes_filename=single_emotes_filename)
+                                         single_emotes_filename=single_emotes_filename,
+                                         encoder_profile=encoder_profile)
         self._image_name = '{}/{}'.format(self.get_folder_name(self.image_url), self.get_file_name(self.image_url))
         self._emotes = emotes
-        self._apng_frames = None
+        self._is_apng = False
         self._single_emotes_filename_apng = single_emotes_filename_apng
+        self._hashes = hashes
         
+    def __getstate__(self):
+        state = BasicEmotesProcessor.__getstate__(self)
+        # records made in another process come back through get_result()
+        state['_emotes'] = []
+        return state
+
+    def get_result(self):
+        result = BasicEmotesProcessor.get_result(self)
+        result['emotes'] = self._emotes
+        result['hashes'] = self._hashes.new_entries()
+        return result
+
+    def merge_result(self, result):
+        BasicEmotesProcessor.merge_result(self, result)
+        with self.scraper.mutex:
+            self._emotes.extend(result['emotes'])
+        self._hashes.update(result['hashes'])
+
+    def hash_output(self, file_name, prefix, data=None):
+        """
+        sha1 of prefix + the file's content, from data if the file was just written with it.
+        """
+        if data is not None:
+            digest = hash_bytes(data, prefix)
+        else:
+            digest = self._hashes.get(file_name, prefix)
+            if digest:
+                return digest
+            digest = hashfile(file_name, prefix)
+        self._hashes.add(file_name, prefix, digest)
+        return digest
+
     def load_image(self, image_file):
         BasicEmotesProcessor.load_image(self, image_file)
         if self.is_apng(self.image_data):
             self.image = None
-            self._apng_frames = []
-            
-            apng_file = os.path.sep.join([self.scraper.cache_dir, 
-                                          'apng', 
-                                          self.get_folder_name(self.image_url), 
-                                          self.get_file_name(self.image_url), 
-                                          self.get_file_name(self.image_url)])
-            
-            if not os.path.exists(apng_file):
-                if not os.path.exists(os.path.dirname(apng_file)):
-                    try:
-                        os.makedirs(os.path.dirname(apng_file))
-                    except OSError:
-                        pass 
-        
-                copyfile(image_file, apng_file)
-                
-            FNULL = open(os.devnull, 'wb')
-            check_call(['apngdis', apng_file, 'frame_'], stdout=FNULL)
-            FNULL.close()
-            
-            frames = sorted(glob(os.path.sep.join([os.path.dirname(apng_file), 'frame_*.png'])))
-            delay_files = sorted(glob(os.path.sep.join([os.path.dirname(apng_file), 'frame_*.txt'])))
-            assert len(frames) > 0, 'No frames found'
-            
-            delays = {}            
-            default_delay = self._calculate_delay(delay_files[0])
-            for delay_file in delay_files:
-                delays[os.path.splitext(delay_file)[0] + '.png'] = self._calculate_delay(delay_file)
-            
-            for idx, frame in enumerate(frames):
-                apng = {}
-                apng['index'] = idx
-                
-                f = open(frame, 'rb')
-                apng['image'] = f.read()
-                f.close()
-                
-                if frame in delays:                         
-                    apng['delay'] = delays[frame]
-                else:
-                    logger.warning('No delay found for "%s", using default (%s ms)', frame, default_delay)
-                    apng['delay'] = default_delay
-                
-                self._apng_frames.append(apng)
-                  
-    def _calculate_delay(self, delay_file):
-        # Calucate delay in ms
-        f = open(delay_file, 'r')
-        delay_text = f.readline().strip()[6:]
-        f.close()
+            self._is_apng = True
+
+    def iter_apng_frames(self):
+        """
+        Yields ({'index', 'delay' in ms}, frame image) for the frames of the animation. Pillow
+        composites them (dispose and blend ops) as it seeks, so only one is decoded at a time.
+        """
+        with Image.open(BytesIO(self.image_data)) as apng:
+            # a default image that isn't part of the animation is only for viewers without apng support
+            first_frame = 1 if apng.default_image else 0
+            assert apng.n_frames > first_frame, 'No frames found'
+
+            for index, frame_number in enumerate(range(first_frame, apng.n_frames)):
+                apng.seek(frame_number)
+                frame = {'index': index,
+                         'delay': int(round(apng.info.get('duration', 0)))}
+                yield frame, apng.convert('RGBA')
 
-        return int(round(float(delay_text[0:delay_text.index('/')]) / float(delay_text[delay_text.index('/') + 1:]) * 1000))  
-    
     def _hash_emote(self, emote):
         s = emote['name'] + emote['image'] + ('T' if emote['apng'] else "F") + ('T' if emote['nsfw'] else "F")
         if emote['apng']:
@@ -139,52 +156,65 @@ class AndroidEmotesProcessor(BasicEmotesProcessor, APNGCheck):
         return djb2(s)
         
         
-    def process_emote(self, emote):
-        if self.is_apng(self.image_data):
-            logger.debug('Found apng image: %s', self._image_name)
-            for frame in self._apng_frames:
-                image = Image.open(BytesIO(frame['image']))
-                cropped = self.extract_single_image(emote, image)
-                
-                file_name = self._single_emotes_filename_apng.format(emote['sr'], max(emote['names'], key=len), frame['index'])
-                emote_url = '{}/{}_frame_{:0>3}.png'.format(emote['sr'], max(emote['names'], key=len), frame['index'])
-                
-                try:
-                    if not os.path.exists(file_name):
-                        if not os.path.exists(os.path.dirname(file_name)):
-                            try:
-                                os.makedirs(os.path.dirname(file_name))
-                            except OSError:
-                                pass
-                            
-                        f = open(file_name, 'wb')
-                        cropped.save(f)
-                        f.close()
-                    
-                    
-                    a_emote = {'names': emote['names'],
-                               'image': emote_url,
-                               'hash': hashfile(file_name, '{}.{}'.format(emote_url, frame['delay'])),
-                               'index': frame['index'],
-                               'delay': frame['delay'],
-                               'apng': True,
-                               'sr': emote['sr'],
-                               'nsfw': True if 'nsfw' in emote and emote['nsfw'] else False}
-                    with self.scraper.mutex:
-                        self._emotes.append(a_emote)
-                    
-                except Exception as e:
-                    logger.exception(e)
-                    raise e
-            
+    def process_group(self):
+        self.load_image(self.scraper.get_image_path(self.image_url))
+        if not self._is_apng:
+            AbstractEmotesProcessor.process_group(self)
         else:
-            BasicEmotesProcessor.process_emote(self, emote)
-            emote_url = '{}/{}.png'.format(emote['sr'], max(emote['names'], key=len))
-            a_emote = {'names': emote['names'],
-                       'image': emote_url,
-                       'hash': hashfile(self.single_emotes_filename.format(emote['sr'], max(emote['names'], key=len)), '{}.0'.format(emote_url)),
-                       'apng': False,
-                       'sr': emote['sr'],
-                       'nsfw': True if 'nsfw' in emote and emote['nsfw'] else False}
+            self.process_apng_group()
+
+    def process_apng_group(self):
+        logger.debug('Found apng image: %s', self._image_name)
+        # frames in the outer loop, so each is decoded once for the whole group and freed after
+        records = [[] for emote in self.group]
+        try:
+            for frame, image in self.iter_apng_frames():
+                for emote, emote_records in zip(self.group, records):
+                    emote_records.append(self.process_apng_frame(emote, frame, image))
+        finally:
+            # same order as one emote at a time
             with self.scraper.mutex:
-                self._emotes.append(a_emote)
+                for emote_records in records:
+                    self._emotes.extend(emote_records)
+
+    def process_apng_frame(self, emote, frame, image):
+        file_name = self._single_emotes_filename_apng.format(emote['sr'], max(emote['names'], key=len), frame['index'])
+        emote_url = '{}/{}_frame_{:0>3}.png'.format(emote['sr'], max(emote['names'], key=len), frame['index'])
+
+        try:
+            data = None
+            if not os.path.exists(file_name):
+                if not os.path.exists(os.path.dirname(file_name)):
+                    try:
+                        os.makedirs(os.path.dirname(file_name))
+                    except OSError:
+                        pass
+
+                data = self.encode_image(self.extract_single_image(emote, image))
+                f = open(file_name, 'wb')
+                f.write(data)
+                f.close()
+
+            return {'names': emote['names'],
+                    'image': emote_url,
+                    'hash': self.hash_output(file_name, '{}.{}'.format(emote_url, frame['delay']), data),
+                    'index': frame['index'],
+                    'delay': frame['delay'],
+                    'apng': True,
+                    'sr': emote['sr'],
+                    'nsfw': True if 'nsfw' in emote and emote['nsfw'] else False}
+        except Exception as e:
+            logger.exception(e)
+            raise e
+
+    def process_emote(self, emote):
+        data = BasicEmotesProcessor.process_emote(self, emote)
+        emote_url = '{}/{}.png'.format(emote['sr'], max(emote['names'], key=len))
+        a_emote = {'names': emote['names'],
+                   'image': emote_url,
+                   'hash': self.hash_output(self.single_emotes_filename.format(emote['sr'], max(emote['names'], key=len)), '{}.0'.format(emote_url), data),
+                   'apng': False,
+                   'sr': emote['sr'],
+                   'nsfw': True if 'nsfw' in emote and emote['nsfw'] else False}
+        with self.scraper.mutex:
+            self._emotes.append(a_emote)
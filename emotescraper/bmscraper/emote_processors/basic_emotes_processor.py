@@ -22,37 +22,60 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Pillow PNG options for cropped emotes, pick one per deployment to trade encoding time for file size.
+# keep_palette saves crops of palette images as palette images instead of RGBA.
+ENCODER_PROFILES = {
+    'fast': {'compress_level': 1, 'optimize': False, 'keep_palette': True},
+    'default': {'compress_level': 6, 'optimize': False, 'keep_palette': True},
+    'small': {'compress_level': 9, 'optimize': True, 'keep_palette': True},
+}
+
+
+def get_encoder_profile(profile):
+    """
+    The options for a profile name, a dict of options gets the rest from the default profile.
+    """
+    if profile is None:
+        return ENCODER_PROFILES['default']
+    if isinstance(profile, dict):
+        return dict(ENCODER_PROFILES['default'], **profile)
+    return ENCODER_PROFILES[profile]
+
 
 class BasicEmotesProcessorFactory(AbstractEmotesProcessorFactory):
-    def __init__(self, single_emotes_filename=None):
+    def __init__(self, single_emotes_filename=None, encoder_profile=None):
         super(BasicEmotesProcessorFactory, self).__init__()
         self.single_emotes_filename = single_emotes_filename
+        self.encoder_profile = get_encoder_profile(encoder_profile)
 
     def new_processor(self, scraper=None, image_url=None, group=None):
         return BasicEmotesProcessor(scraper=scraper,
                                     image_url=image_url,
                                     group=group,
-                                    single_emotes_filename=self.single_emotes_filename)
+                                    single_emotes_filename=self.single_emotes_filename,
+                                    encoder_profile=self.encoder_profile)
 
 
 class BasicEmotesProcessor(AbstractEmotesProcessor, FileNameUtils):
-    def __init__(self, scraper=None, image_url=None, group=None, single_emotes_filename=None):
+    def __init__(self, scraper=None, image_url=None, group=None, single_emotes_filename=None, encoder_profile=None):
         AbstractEmotesProcessor.__init__(self, scraper=scraper, image_url=image_url, group=group)
 
         self.single_emotes_filename = single_emotes_filename
+        self.encoder_profile = get_encoder_profile(encoder_profile)
         self.image_data = None
         self.image = None
-
+        # encoded crops of self.image by crop box, emotes on the same sheet often share one
+        self._encoded_crops = {}
 
     def process_group(self):
-        self.load_image(self.get_file_path(self.image_url, self.scraper.cache_dir))
+        self.load_image(self.scraper.get_image_path(self.image_url))
         AbstractEmotesProcessor.process_group(self)
 
     def process_emote(self, emote):
         file_name = self.single_emotes_filename.format(emote['sr'], max(emote['names'], key=len))
         if not os.path.exists(file_name):
-            cropped = self.extract_single_image(emote, self.image)
-            if cropped:
+            data = self.encode_single_image(emote)
+            if data:
                 try:
                     if not os.path.exists(os.path.dirname(file_name)):
                         try:
@@ -61,8 +84,9 @@ class BasicEmotesProcessor(AbstractEmotesProcessor, FileNameUtils):
                             pass
 
                     f = open(file_name, 'wb')
-                    cropped.save(f)
+                    f.write(data)
                     f.close()
+                    return data
                 except Exception as e:
                     logger.exception(e)
 
@@ -73,7 +97,34 @@ class BasicEmotesProcessor(AbstractEmotesProcessor, FileNameUtils):
 
         self.image = Image.open(BytesIO(self.image_data))
 
-    def extract_single_image(self, emote, image):
+    def encode_single_image(self, emote):
+        box = self.get_crop_box(emote)
+        if box not in self._encoded_crops:
+            if self.is_whole_image(box):
+                # the source png is exactly the emote, no need to decode and encode it again
+                self._encoded_crops[box] = self.image_data
+            else:
+                cropped = self.extract_single_image(emote, self.image)
+                if not cropped:
+                    return None
+                self._encoded_crops[box] = self.encode_image(cropped)
+        return self._encoded_crops[box]
+
+    def is_whole_image(self, box):
+        return (tuple(box) == (0, 0) + self.image.size
+                and self.image.format == 'PNG'
+                and not getattr(self.image, 'is_animated', False))
+
+    def encode_image(self, image):
+        if image.mode == 'P' and not self.encoder_profile['keep_palette']:
+            image = image.convert('RGBA')
+        f = BytesIO()
+        image.save(f, 'PNG',
+                   compress_level=self.encoder_profile['compress_level'],
+                   optimize=self.encoder_profile['optimize'])
+        return f.getvalue()
+
+    def get_crop_box(self, emote):
         x = 0
         y = 0
         width = emote['width']
@@ -89,4 +140,7 @@ class BasicEmotesProcessor(AbstractEmotesProcessor, FileNameUtils):
                 if emote['background-position'][1].endswith('%'):
                     y = height * y / 100;
 
-        return image.crop((x, y, x + width, y + height))
\ No newline at end of file
+        return (x, y, x + width, y + height)
+
+    def extract_single_image(self, emote, image):
+        return image.crop(self.get_crop_box(emote))
\ No newline at end of file
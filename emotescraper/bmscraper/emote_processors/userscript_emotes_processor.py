@@ -26,8 +26,11 @@ class UserscriptEmotesProcessorFactory(BasicEmotesProcessorFactory):
     def __init__(self,
                  single_emotes_filename='single_emotes/{}/{}.png',
                  apng_dir='images',
-                 apng_url='images/{}/{}'):
-        BasicEmotesProcessorFactory.__init__(self, single_emotes_filename=single_emotes_filename)
+                 apng_url='images/{}/{}',
+                 encoder_profile=None):
+        BasicEmotesProcessorFactory.__init__(self,
+                                             single_emotes_filename=single_emotes_filename,
+                                             encoder_profile=encoder_profile)
         self.apng_dir = apng_dir
         self.apng_url = apng_url
 
@@ -37,17 +40,19 @@ class UserscriptEmotesProcessorFactory(BasicEmotesProcessorFactory):
                                          group=group,
                                          single_emotes_filename=self.single_emotes_filename,
                                          apng_dir=self.apng_dir,
-                                         apng_url=self.apng_url)
+                                         apng_url=self.apng_url,
+                                         encoder_profile=self.encoder_profile)
 
 
 class UserscriptEmotesProcessor(BasicEmotesProcessor, APNGCheck):
     def __init__(self, scraper=None, image_url=None, group=None, single_emotes_filename=None,
-                 apng_dir=None, apng_url=None):
+                 apng_dir=None, apng_url=None, encoder_profile=None):
         BasicEmotesProcessor.__init__(self,
                                       scraper=scraper,
                                       image_url=image_url,
                                       group=group,
-                                      single_emotes_filename=single_emotes_filename)
+                                      single_emotes_filename=single_emotes_filename,
+                                      encoder_profile=encoder_profile)
         self.apng_dir = apng_dir
         self.apng_url = apng_url
 
@@ -0,0 +1,119 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# manifests already read by this process by (path, mtime), pool processes read each once
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def hash_bytes(data, prefix=None):
+    sha1 = hashlib.sha1()
+    if prefix:
+        sha1.update(prefix.encode('utf-8'))
+    sha1.update(data)
+    return sha1.hexdigest()
+
+
+def _load_entries(path):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+
+    with _loaded_lock:
+        if (path, mtime) not in _loaded:
+            try:
+                with open(path, 'r', encoding='utf8') as f:
+                    entries = json.load(f)
+            except ValueError:
+                logger.error("Hash manifest {} is broken, starting over".format(path))
+                entries = {}
+            _loaded.clear()
+            _loaded[(path, mtime)] = entries
+        return _loaded[(path, mtime)]
+
+
+class HashManifest(object):
+    """
+    sha1 of prefix + content of files the scraper wrote, by path. An entry is trusted as long
+    as the file's size and mtime are the ones it was recorded with, so unchanged files aren't
+    read again.
+
+    Pickles without its entries, a copy in a pool process reads the manifest file itself and
+    hands what it added back through new_entries().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._new = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def get(self, path, prefix):
+        """
+        The recorded sha1 for path, None if there is none or the file changed since.
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = _load_entries(self.path)
+            entry = self._new.get(path) or self._entries.get(path)
+        if not entry:
+            return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if [stat.st_size, stat.st_mtime_ns, prefix] != entry[:3]:
+            return None
+        return entry[3]
+
+    def add(self, path, prefix, digest):
+        stat = os.stat(path)
+        with self._lock:
+            self._new[path] = [stat.st_size, stat.st_mtime_ns, prefix, digest]
+
+    def new_entries(self):
+        with self._lock:
+            return dict(self._new)
+
+    def update(self, entries):
+        with self._lock:
+            self._new.update(entries)
+
+    def save(self):
+        with self._lock:
+            if not self._new:
+                return
+            if self._entries is None:
+                self._entries = _load_entries(self.path)
+            entries = dict(self._entries)
+            entries.update(self._new)
+
+        if not os.path.exists(os.path.dirname(self.path) or '.'):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(entries, f, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,75 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_NAME = 'images.bundle'
+CHUNK_SIZE = 64 * 1024
+
+
+def get_signature(members):
+    """
+    sha1 of the [(image, hash)] a bundle is made of, it changes whenever one of them does.
+    """
+    return hashlib.sha1(json.dumps(members, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def bundle_subreddit(root, subreddit, records, hashes):
+    """
+    Packs the single emote files of a subreddit's Android records into one uncompressed
+    root/subreddit/images.bundle, so clients can get them in one request and use ranged reads,
+    and adds 'bundle', 'offset' and 'length' to the records.
+
+    The bundle is only written again when its members changed, its signature is kept in the
+    HashManifest of the single emote files. Returns whether it was written.
+    """
+    members = sorted(set((record['image'], record['hash']) for record in records))
+    bundle = '{}/{}'.format(subreddit, BUNDLE_NAME)
+    bundle_path = os.path.join(root, subreddit, BUNDLE_NAME)
+    signature = get_signature(members)
+
+    index = {}
+    written = hashes.get(bundle_path, signature) is None
+    if written:
+        sha1 = hashlib.sha1()
+        offset = 0
+        if not os.path.exists(os.path.dirname(bundle_path)):
+            os.makedirs(os.path.dirname(bundle_path))
+        with open(bundle_path + '.tmp', 'wb') as dst:
+            for image, digest in members:
+                length = 0
+                with open(os.path.join(root, image), 'rb') as src:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        dst.write(chunk)
+                        sha1.update(chunk)
+                        length += len(chunk)
+                index[image] = (offset, length)
+                offset += length
+        os.replace(bundle_path + '.tmp', bundle_path)
+        hashes.add(bundle_path, signature, sha1.hexdigest())
+        logger.debug('Wrote {} with {} images'.format(bundle, len(members)))
+    else:
+        # same members as last time, so the same layout
+        offset = 0
+        for image, digest in members:
+            length = os.path.getsize(os.path.join(root, image))
+            index[image] = (offset, length)
+            offset += length
+
+    for record in records:
+        record['bundle'] = bundle
+        record['offset'], record['length'] = index[record['image']]
+    return written
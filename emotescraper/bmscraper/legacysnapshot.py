@@ -0,0 +1,90 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import copy
+import hashlib
+import json
+import os
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# bump whenever parse_css() output changes, so old snapshots get rebuilt
+SNAPSHOT_VERSION = 1
+
+
+class LegacySnapshot(object):
+    """
+    The parsed emotes of the legacy_css stylesheets, kept in a single file.
+    Those subreddits are gone and their css never changes, so a stylesheet is
+    only parsed again when its sha1 doesn't match the one it was compiled from.
+    """
+
+    def __init__(self, path, css_dir, parse):
+        self.path = path
+        self.css_dir = css_dir
+        self.parse = parse
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf8') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('version') == SNAPSHOT_VERSION:
+                    self._entries = snapshot['stylesheets']
+            except (ValueError, KeyError):
+                logger.error("Legacy css snapshot {} is broken, rebuilding it".format(self.path))
+
+    def get(self, subreddit):
+        """
+        (css digest, emotes staging) of a legacy subreddit, None if it has no stylesheet.
+        """
+        css_path = os.path.join(self.css_dir, subreddit + '.css')
+        try:
+            stat = os.stat(css_path)
+        except OSError:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(subreddit)
+
+        # size and mtime unchanged means the file is, otherwise let the hash decide
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            with open(css_path, 'r', encoding='utf8') as css_file:
+                css = css_file.read()
+            css_digest = hashlib.sha1(css.encode('utf-8')).hexdigest()
+
+            if entry is None or entry['css'] != css_digest:
+                logger.debug('Compiling legacy css for {}'.format(subreddit))
+                entry = {'css': css_digest, 'emotes': self.parse(css) or {}}
+            entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+
+            with self._lock:
+                self._entries[subreddit] = entry
+                self._dirty = True
+
+        return entry['css'], copy.deepcopy(entry['emotes'])
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # no sort_keys, the order of the emotes and their rules matters to the scraper
+            data = json.dumps({'version': SNAPSHOT_VERSION, 'stylesheets': self._entries},
+                              separators=(',', ':'))
+            self._dirty = False
+
+        with open(self.path + '.tmp', 'w', encoding='utf8') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,215 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import gzip
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    logger.warning('Brotli is not available')
+    brotli = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+def json_chunks(items, separators=(',', ':')):
+    """
+    The same bytes as json.dumps(items, separators=separators).encode('utf-8') for a
+    list, one item at a time.
+    """
+    yield b'['
+    for i, item in enumerate(items):
+        if i:
+            yield separators[0].encode('utf-8')
+        yield json.dumps(item, separators=separators).encode('utf-8')
+    yield b']'
+
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_gzip(path, data, level=9):
+    """
+    Writes data gzipped to path, atomically and only if path doesn't hold that data already.
+    Returns whether it wrote.
+    """
+    sha1 = hashlib.sha1()
+    try:
+        with gzip.open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha1.update(chunk)
+        if sha1.hexdigest() == hashlib.sha1(data).hexdigest():
+            return False
+    except (OSError, EOFError):
+        pass
+
+    _make_dirs(path)
+    with open(path + '.tmp', 'wb') as f:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=f, mtime=0) as gz:
+            gz.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def _make_dirs(path):
+    if not os.path.exists(os.path.dirname(path) or '.'):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def _gzip(src, dst, level):
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=dst, mtime=0) as gz:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            gz.write(chunk)
+
+
+def _brotli(src, dst, quality):
+    compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=quality)
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+        dst.write(compressor.process(chunk))
+    dst.write(compressor.finish())
+
+
+class OutputFile(object):
+    """
+    A data file being written by an OutputWriter. Goes to a temporary file while it is
+    hashed, what happens to it is up to OutputWriter.finish().
+    """
+
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.changed = None
+        # sha1 of what was written, once closed
+        self.digest = None
+        self._sha1 = hashlib.sha1()
+        self._size = 0
+        _make_dirs(path)
+        self._file = open(self.temp_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self._file.close()
+            os.unlink(self.temp_path)
+        else:
+            self.close()
+
+    def write(self, data):
+        self._file.write(data)
+        self._sha1.update(data)
+        self._size += len(data)
+
+    def close(self):
+        self._file.close()
+        self.digest = self._sha1.hexdigest()
+        try:
+            self.changed = (os.path.getsize(self.path) != self._size
+                            or hash_file(self.path) != self._sha1.hexdigest())
+        except OSError:
+            self.changed = True
+        if not self.changed:
+            os.unlink(self.temp_path)
+        self.writer._closed.append(self)
+
+
+class OutputWriter(object):
+    """
+    Writes data files together with their .gz and .br variants. Data is streamed through a
+    temporary file, so it never has to be in memory as a whole, and files are only replaced
+    (atomically) when their content changed, so unchanged files keep their mtime and CDN
+    caches stay valid. The variants are compressed in parallel from the temporary files,
+    zlib and brotli release the GIL.
+    """
+
+    def __init__(self, gzip_level=9, brotli_quality=11, workers=None):
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.workers = workers
+        self._closed = []
+
+    def get_variants(self, path):
+        """
+        [(path, compress function(source file, destination file))] written next to a data file.
+        """
+        variants = [(path + '.gz', lambda src, dst: _gzip(src, dst, self.gzip_level))]
+        if brotli:
+            variants.append((path + '.br', lambda src, dst: _brotli(src, dst, self.brotli_quality)))
+        return variants
+
+    def open(self, path):
+        return OutputFile(self, path)
+
+    def write_all(self, outputs):
+        """
+        Writes [(path, bytes or iterable of bytes)], returns the paths that were written.
+        """
+        for path, data in outputs:
+            with self.open(path) as output:
+                for chunk in ([data] if isinstance(data, bytes) else data):
+                    output.write(chunk)
+        return self.finish()
+
+    def finish(self):
+        """
+        Compresses and moves into place whatever changed in the files opened so far, returns
+        the paths that were written.
+        """
+        jobs = []
+        for output in self._closed:
+            source = output.temp_path if output.changed else output.path
+            for variant_path, compress in self.get_variants(output.path):
+                if output.changed or not os.path.exists(variant_path):
+                    jobs.append((variant_path, compress, source))
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(lambda job: self._write_variant(*job), jobs))
+        written = [job[0] for job, result in zip(jobs, results) if result]
+
+        for output in self._closed:
+            if output.changed:
+                os.replace(output.temp_path, output.path)
+                written.append(output.path)
+        self._closed = []
+        return written
+
+    def _write_variant(self, path, compress, source):
+        try:
+            with open(source, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+                compress(src, dst)
+            os.replace(path + '.tmp', path)
+            return True
+        except Exception:
+            logger.exception('Unable to write {}'.format(path))
+            # a stale variant would be served for the new data
+            for stale_path in (path, path + '.tmp'):
+                try:
+                    os.unlink(stale_path)
+                except FileNotFoundError:
+                    pass
+            return False
@@ -24,6 +24,7 @@
 
 from time import time, sleep
 from threading import Lock
+from email.utils import parsedate_to_datetime
 
 
 class TokenBucket:
@@ -70,4 +71,107 @@ class TokenBucket:
             else:
                 return abs((self.per_seconds / self.rate) - self.tokens)
 
+    def update(self, response):
+        """
+        Feedback from a finished request, a fixed bucket ignores it.
+        """
+        pass
+
+
+def _parse_header_value(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # Retry-After may also be a HTTP date
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_budget_headers(response):
+    """
+    Headers of the most recent response in a redirect chain that reports the rate limit budget,
+    a stylesheet redirected to a CDN only has it on the redirect.
+    """
+    for r in [response] + list(reversed(getattr(response, 'history', None) or [])):
+        if 'X-Ratelimit-Remaining' in r.headers:
+            return r.headers
+    return response.headers
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    A token bucket that adjusts its rate from the responses it is fed through
+    update() (additive-increase, multiplicative-decrease).
+
+    Every successful response that reports the budget in X-Ratelimit-Remaining /
+    X-Ratelimit-Reset raises the rate by `increase`, but never above what is
+    left of it. Without those headers the rate stays where it is, there is
+    nothing to tell how close to being throttled it is. A 429 multiplies the
+    rate by `decrease` and honours Retry-After. An empty
+    budget or a Retry-After is turned into token debt, so waiting callers
+    line up behind it instead of bursting once it has passed.
+
+    Unlike TokenBucket, acquire() sleeps outside the lock so update() never
+    waits for a sleeping caller.
+    """
+
+    def __init__(self, rate=1, per_seconds=1, min_rate=None, max_rate=None, increase=None, decrease=0.5,
+                 headroom=0.9):
+        TokenBucket.__init__(self, rate, per_seconds)
+        self.min_rate = min_rate if min_rate is not None else rate / 10.0
+        self.max_rate = max_rate if max_rate is not None else rate * 10.0
+        self.increase = increase if increase is not None else rate / 10.0
+        self.decrease = decrease
+        self.headroom = headroom
+
+    def acquire(self):
+        with self.lock:
+            self.increment()
+            wait = 0
+            if self.tokens < 1:
+                wait = (1 - self.tokens) * self.per_seconds / self.rate
+            self.tokens -= 1
+
+        if wait > 0:
+            sleep(wait)
+        return 0
+
+    def update(self, response):
+        if response is None:
+            return
+
+        headers = _get_budget_headers(response)
+        remaining = _parse_header_value(headers.get('X-Ratelimit-Remaining'))
+        reset = _parse_header_value(headers.get('X-Ratelimit-Reset'))
+        retry_after = _parse_header_value(response.headers.get('Retry-After'))
+
+        with self.lock:
+            self.increment()
+
+            if response.status_code == 429:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._pause(retry_after if retry_after is not None else reset)
+                return
+
+            if remaining is not None and reset:
+                # spread what is left of the budget over the rest of the window
+                rate = min(self.max_rate, self.rate + self.increase,
+                           remaining / reset * self.per_seconds * self.headroom)
+                self.rate = max(self.min_rate, rate)
+
+            if retry_after is not None:
+                self._pause(retry_after)
+            elif remaining is not None and remaining < 1 and reset:
+                self._pause(reset)
+
+    def _pause(self, seconds):
+        if not seconds:
+            return
+        self.tokens = min(self.tokens, 1 - seconds * self.rate / self.per_seconds)
+
 
@@ -0,0 +1,114 @@
+# --------------------------------------------------------------------
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from heapq import heappush, heappop
+from itertools import count
+from random import uniform
+from time import time
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, base_delay=2, max_delay=120):
+    """
+    Exponential backoff with jitter: half of the delay is fixed, the other
+    half random, so retries of jobs that failed together spread out.
+    """
+    delay = min(max_delay, base_delay * 2 ** max(0, attempt - 1))
+    return delay / 2 + uniform(0, delay / 2)
+
+
+class RetryBudget(object):
+    """
+    Number of retries all jobs of a run may use together, None for no limit.
+    """
+
+    def __init__(self, limit=None):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining is None:
+                return True
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class RetryScheduler(object):
+    """
+    Delay queue in front of a WorkerPool. Failed jobs are held here until
+    their backoff has passed and then put back on the pool, so a failing
+    URL doesn't keep a worker asleep.
+
+    join() waits until neither the pool nor the delay queue have work left
+    and then shuts the pool down.
+    """
+
+    def __init__(self, workpool, budget=None):
+        self.workpool = workpool
+        self.budget = budget or RetryBudget()
+        self._queue = []
+        self._sequence = count()
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, job, delay):
+        if not self.budget.take():
+            return False
+
+        with self._condition:
+            heappush(self._queue, (time() + delay, next(self._sequence), job))
+            self._pending += 1
+            self._condition.notify_all()
+        return True
+
+    def _run(self):
+        with self._condition:
+            while not self._closed:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                due = self._queue[0][0]
+                now = time()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+
+                job = heappop(self._queue)[2]
+                # put before the job stops being pending, so join() never sees it in neither place
+                self.workpool.put(job)
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def join(self):
+        while True:
+            self.workpool.join()
+            with self._condition:
+                if self._pending == 0 and self.workpool.unfinished_tasks == 0:
+                    break
+                self._condition.wait_for(lambda: self._pending == 0)
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+        self.workpool.shutdown()
+        self.workpool.join()
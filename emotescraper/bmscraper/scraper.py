@@ -14,6 +14,7 @@
 from datetime import datetime, timedelta
 from dateutil.tz import tzutc
 import requests
+from requests.adapters import HTTPAdapter
 from workerpool import WorkerPool
 import threading
 import tinycss
@@ -21,17 +22,117 @@ import re
 from collections import defaultdict
 import itertools
 import os
+import copy
+import json
+import hashlib
+from urllib.parse import urlsplit
 from .downloadjob import DownloadJob
+from .asyncdownloader import AsyncDownloader
 from .filenameutils import FileNameUtils
+from .blobstore import BlobStore
+from .legacysnapshot import LegacySnapshot
+from .emote_processors.abstract_emotes_processor import process_in_worker
+from .cssfilter import extract_emote_rules
 from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dateutil import parser
 from operator import itemgetter
 from .ratelimiter import TokenBucket
+from .retryscheduler import RetryScheduler, RetryBudget
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+REDDIT_ORIGIN = 'https://old.reddit.com'
+IMAGE_CHUNK_SIZE = 64 * 1024
+# emotes tagged with an added_date in this window get the 'new' tag
+NEW_EMOTE_AGE = timedelta(days=7)
+_SCHEME_PREFIX = re.compile(r'^(https?:)?//')
+# bump whenever what _save_state() writes changes meaning
+SCRAPE_STATE_VERSION = 2
+
+
+def parse_css(data, filtered=True):
+    """
+    Parses a stylesheet into {emote name: css rules}. A module level function
+    so it can run in a ProcessPoolExecutor. filtered=False has tinycss parse
+    all of it instead of just what extract_emote_rules() keeps.
+    """
+    cssparser = tinycss.make_parser('page3')
+    css = cssparser.parse_stylesheet(extract_emote_rules(data) if filtered else data)
+
+    if not css:
+        return None
+
+    re_emote = re.compile(r'a\[href[|^$]?=["\']\/([\w:]+)["\']\](:hover)?(\sem|\sstrong)?')
+    emotes_staging = defaultdict(dict)
+
+    for rule in css.rules:
+        if re_emote.match(rule.selector.as_css()):
+            for match in re_emote.finditer(rule.selector.as_css()):
+                rules = {}
+
+                for declaration in rule.declarations:
+                    if match.group(3):
+                        name = match.group(3).strip() + '-' + declaration.name
+                        rules[name] = declaration.value.as_css()
+                        emotes_staging[match.group(1)].update(rules)
+                    elif declaration.name in ['text-align',
+                                              'line-height',
+                                              'color'] or declaration.name.startswith('font') or declaration.name.startswith('text'):
+                        name = 'text-' + declaration.name
+                        rules[name] = declaration.value.as_css()
+                        emotes_staging[match.group(1)].update(rules)
+                    elif declaration.name in ['width',
+                                               'height',
+                                               'background-image',
+                                               'background-position',
+                                               'background', ]:
+                        name = declaration.name
+                        if name == 'background-position':
+                            val = ['{}{}'.format(v.value, v.unit if v.unit else '') for v in declaration.value if
+                                   v.value != ' ']
+                        else:
+                            val = declaration.value[0].value
+                        if match.group(2):
+                            name = 'hover-' + name
+                        rules[name] = val
+                        emotes_staging[match.group(1)].update(rules)
+    return emotes_staging
+
+
+def rule_fingerprint(rules):
+    """
+    Digest of an emote's css rules that doesn't depend on the order they were declared in.
+    """
+    return hashlib.sha1(json.dumps(rules, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ProcessorContext(object):
+    """
+    What emote processors use of the scraper, in a form that can be sent to a pool process.
+    """
+
+    def __init__(self, image_paths):
+        self.image_paths = image_paths
+        self.mutex = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['mutex']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mutex = threading.RLock()
+
+    def get_image_path(self, image_url):
+        return self.image_paths.get(image_url)
+
+    def get_processor_context(self, image_url):
+        return self
+
 
 class BMScraper(FileNameUtils):
     def __init__(self, processor_factory):
@@ -46,14 +147,42 @@ class BMScraper(FileNameUtils):
         self.tags_data = {}
         self.cache_dir = '../images'
         self.workers = cpu_count()
+        # 'threads' runs downloads on a WorkerPool, 'asyncio' on a single event loop (needs aiohttp and yarl)
+        self.fetch_engine = 'threads'
+        self.max_in_flight = 64
+        # largest image download in bytes that is accepted, None for no limit
+        self.max_image_size = None
+        # retries all downloads of one scrape() may use together, None for no limit
+        self.retry_budget = 500
+        self._retry_budget = None
+        self._image_store = None
+        # reuse the emotes of subreddits whose css and config didn't change since the last run
+        self.incremental = False
+        # parse css in this many processes instead of the fetching threads, None to parse in-thread
+        self.parse_processes = None
+        self._parse_pool = None
+        # run the emote processors in this many processes instead of the worker threads, None for threads
+        self.image_processes = None
+        self._legacy_snapshot = None
+        # lookup tables built from the config lists above, see _compile_config()
+        self._emote_info_index = {}
+        self._emote_tags = {}
+        self._image_blacklist = frozenset()
+        self._sorted_image_blacklist = None
+        self._state = {}
+        self._new_state = {}
+        self._unchanged_subreddits = set()
+        self._skipped_subreddits = set()
+        self._incomplete_subreddits = set()
         self.processor_factory = processor_factory
         self.rate_limit_lock = None
 
         self.mutex = threading.RLock()
 
-        self._requests = requests.Session()
-        # self._requests.headers = {'user-agent', 'User-Agent: Ponymote harvester v2.0 by /u/marminatoror'}
-        self._requests.headers.update({
+        # One session per origin, so every host gets a connection pool as big as the worker pool
+        self._sessions = {}
+        # self.headers = {'user-agent', 'User-Agent: Ponymote harvester v2.0 by /u/marminatoror'}
+        self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/114.0",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
             "Accept-Language": "en-US,en;q=0.5",
@@ -65,167 +194,353 @@ class BMScraper(FileNameUtils):
             "Sec-Fetch-User": "?1",
             "Connection": "keep-alive",
             "TE": "trailers",
-        })
+        }
+
+    def _get_session(self, url):
+        parts = urlsplit(url)
+        origin = '{}://{}'.format(parts.scheme, parts.netloc)
+        with self.mutex:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_maxsize=self.workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[origin] = session
+            return session
+
+    def _log_connection_stats(self):
+        with self.mutex:
+            for origin, session in self._sessions.items():
+                adapter = session.get_adapter(origin)
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    logger.info('{}://{}: {} requests over {} connections ({} reused)'.format(
+                        key.key_scheme, key.key_host, pool.num_requests, pool.num_connections,
+                        pool.num_requests - pool.num_connections))
 
     def _dedupe_emotes(self):
+        """
+        Every emote name belongs to the first subreddit in self.subreddits that has it, the
+        others lose it. Emotes from subreddits that aren't in the list lose every listed name.
+        """
         with self.mutex:
-            for subreddit in self.subreddits:
-                subreddit_emotes = [
-                    x for x in self.emotes if x['sr'] == subreddit]
-                other_subreddits_emotes = [
-                    x for x in self.emotes if x['sr'] != subreddit]
-                for subreddit_emote in subreddit_emotes:
-                    for emote in other_subreddits_emotes:
-                        for name in subreddit_emote['names']:
-                            if name in emote['names']:
-                                emote['names'].remove(name)
-                                logger.debug(
-                                    'Removing {} from {}'.format(name, emote['sr']))
-                                if len(emote['names']) == 0:
-                                    logger.debug('Completely removed')
-                                    self.emotes.remove(emote)
+            emotes = list(self.emotes)
+
+        priority = {}
+        for i, subreddit in enumerate(self.subreddits):
+            priority.setdefault(subreddit, i)
+        unlisted = len(self.subreddits)
+
+        # name -> priority of the subreddit that owns it
+        owners = {}
+        for emote in emotes:
+            emote_priority = priority.get(emote['sr'])
+            if emote_priority is None:
+                continue
+            for name in emote['names']:
+                if owners.get(name, unlisted) > emote_priority:
+                    owners[name] = emote_priority
+
+        deduped = []
+        for emote in emotes:
+            emote_priority = priority.get(emote['sr'], unlisted)
+            names = [name for name in emote['names'] if owners.get(name, unlisted) >= emote_priority]
+            if len(names) != len(emote['names']):
+                for name in emote['names']:
+                    if name not in names:
+                        logger.debug('Removing {} from {}'.format(name, emote['sr']))
+                emote['names'][:] = names
+                if len(names) == 0:
+                    logger.debug('Completely removed')
+                    continue
+            deduped.append(emote)
 
-    def _fetch_css(self):
-        logger.debug("Fetching css using {} threads".format(self.workers))
+        with self.mutex:
+            self.emotes = deduped
+
+    def _start_download_jobs(self, jobs):
+        if not self._retry_budget:
+            self._retry_budget = RetryBudget(self.retry_budget)
+
+        if self.fetch_engine == 'asyncio':
+            logger.debug("Downloading with at most {} requests in flight".format(self.max_in_flight))
+            downloader = AsyncDownloader(headers=self.headers,
+                                         cookies=self._get_session(REDDIT_ORIGIN).cookies,
+                                         max_in_flight=self.max_in_flight,
+                                         callback_workers=self.workers,
+                                         retry_budget=self._retry_budget)
+            downloader.start(jobs)
+            return downloader
+
+        logger.debug("Downloading using {} threads".format(self.workers))
         workpool = WorkerPool(size=self.workers)
+        scheduler = RetryScheduler(workpool, budget=self._retry_budget)
+        for job in jobs:
+            job.scheduler = scheduler
+            workpool.put(job)
+        return scheduler
+
+    def _compile_config(self):
+        """
+        Indexes emote_info, tags_data and image_blacklist by name and url, so looking up
+        an emote costs the same however long those lists get.
+        """
+        self._emote_info_index = {}
+        for i, info in enumerate(self.emote_info):
+            self._emote_info_index.setdefault(info['name'], []).append((i, info))
+
+        # [tags, is new] per name, with the dates parsed once instead of for every emote
+        new_cutoff = datetime.now(tzutc()) - NEW_EMOTE_AGE
+        self._emote_tags = {}
+        for name, tag_data in self.tags_data.items():
+            if not tag_data:
+                continue
+            tags = [k for k, v in tag_data['tags'].items() if v['score'] >= 1]
+            if tag_data.get('specialTags'):
+                tags.extend(tag_data['specialTags'])
+            is_new = 'added_date' in tag_data and parser.parse(tag_data['added_date']) > new_cutoff
+            if is_new:
+                tags.append('new')
+            self._emote_tags[name] = [tags, is_new]
+
+        self._image_blacklist = frozenset(self.image_blacklist)
+        self._sorted_image_blacklist = sorted(self.image_blacklist)
 
+    def _fetch_css(self):
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-        for subreddit in self.subreddits:
+        self._compile_config()
 
-            if subreddit in self.legacy_subreddits:
-                legacy_file = '{}/../legacy_css/{}.css'.format(
-                    os.path.dirname(__file__), subreddit)
-                if os.path.exists(legacy_file):
-                    with open(legacy_file) as fh:
-                        css = fh.read()
-                        self._process_stylesheet_response(200,
-                                                          css,
-                                                          "text/css",
-                                                          subreddit)
-                else:
-                    logger.error(
-                        "No css file found for legacy subreddit {}".format(subreddit))
+        jobs = []
+        for subreddit in self.subreddits:
+            if subreddit not in self.legacy_subreddits:
+                jobs.append(DownloadJob(self._get_session(REDDIT_ORIGIN),
+                                        '{}/r/{}/stylesheet'.format(REDDIT_ORIGIN, subreddit),
+                                        retry=5,
+                                        rate_limit_lock=self.rate_limit_lock,
+                                        callback=self._callback_fetch_stylesheet,
+                                        headers=self._get_conditional_headers(subreddit),
+                                        **{'subreddit': subreddit}))
+        legacy_subreddits = [x for x in self.subreddits if x in self.legacy_subreddits]
+
+        if self.parse_processes:
+            logger.debug("Parsing css using {} processes".format(self.parse_processes))
+            self._parse_pool = ProcessPoolExecutor(self.parse_processes)
+            # a forking pool starts all its processes on the first submit, make that happen before the
+            # download threads do, children forked while they hold locks (logging, urllib3) can deadlock
+            self._parse_pool.submit(int).result()
+        try:
+            downloads = self._start_download_jobs(jobs)
+
+            self._legacy_snapshot = LegacySnapshot(os.path.join(self.cache_dir, 'legacy_css.json'),
+                                                   '{}/../legacy_css'.format(os.path.dirname(__file__)),
+                                                   self._parse_css)
+
+            if self._parse_pool:
+                # the threads only wait for the parse pool, keep it busy with legacy css as well
+                with ThreadPoolExecutor(self.parse_processes) as legacy_pool:
+                    list(legacy_pool.map(self._process_legacy_css, legacy_subreddits))
             else:
-                workpool.put(DownloadJob(self._requests,
-                                         'https://old.reddit.com/r/{}/stylesheet'.format(
-                                             subreddit),
-                                         retry=5,
-                                         rate_limit_lock=self.rate_limit_lock,
-                                         callback=self._callback_fetch_stylesheet,
-                                         **{'subreddit': subreddit}))
+                for subreddit in legacy_subreddits:
+                    self._process_legacy_css(subreddit)
+            self._legacy_snapshot.save()
+
+            downloads.join()
+
+            # subreddits finish in any order, keep their emotes in priority order so the output is stable
+            order = dict((subreddit, i) for i, subreddit in enumerate(self.subreddits))
+            with self.mutex:
+                self.emotes.sort(key=lambda e: order.get(e['sr'], len(order)))
+        finally:
+            self._legacy_snapshot = None
+            if self._parse_pool:
+                self._parse_pool.shutdown()
+                self._parse_pool = None
+
+    def _process_legacy_css(self, subreddit):
+        legacy_css = self._legacy_snapshot.get(subreddit)
+        if legacy_css:
+            css_digest, emotes_staging = legacy_css
+            self._process_css(subreddit, css_digest, lambda: emotes_staging)
+        else:
+            logger.error(
+                "No css file found for legacy subreddit {}".format(subreddit))
 
-        workpool.shutdown()
-        workpool.join()
+    def _get_image_store(self):
+        with self.mutex:
+            if self._image_store is None:
+                self._image_store = BlobStore(os.path.join(self.cache_dir, 'blobs'))
+            return self._image_store
+
+    def get_image_path(self, image_url):
+        """
+        Where the cached image for image_url is, None if it wasn't downloaded.
+        """
+        digest = self._get_image_store().get_digest(image_url)
+        if not digest:
+            return None
+        return self._get_image_store().get_path(digest)
 
     def _download_images(self):
-        logger.debug(
-            "Downloading images using {} threads".format(self.workers))
-        workpool = WorkerPool(size=self.workers)
-
         # we are not constrained by the Reddit rate limits here 
         rate_limit = TokenBucket(15, 30)
+        image_store = self._get_image_store()
 
         # cache emotes
+        jobs = []
         key_func = lambda e: e['background-image']
         with self.mutex:
-            for image_url, group in itertools.groupby(sorted(self.emotes, key=key_func), key_func):
-                if not image_url:
+            emotes = [e for e in self.emotes if e['sr'] not in self._skipped_subreddits]
+            for image_url, group in itertools.groupby(sorted(emotes, key=key_func), key_func):
+                if not image_url or image_store.get_digest(image_url):
                     continue
 
-                file_path = self.get_file_path(
-                    image_url, rootdir=self.cache_dir)
-                if not os.path.isfile(file_path):
-                    # Temp workaround for downloading apngs straight from amazon instead of broken ones from cloudflare
-                    # there are some emotes that already have amazonaws in their url, so don't replace it again
-                    if "s3.amazonaws.com" not in image_url:
-                        image_url = re.sub(r'^(https?:)?//', 'https://s3.amazonaws.com/', image_url)
+                # images from before the store was content addressed
+                file_path = self.get_file_path(image_url, rootdir=self.cache_dir)
+                if os.path.isfile(file_path):
+                    image_store.import_file(image_url, file_path)
+                    continue
 
-                    workpool.put(DownloadJob(self._requests,
-                                             image_url,
-                                             retry=5,
-                                             rate_limit_lock=rate_limit,
-                                             callback=self._callback_download_image,
-                                             **{'image_path': file_path}))
+                # Temp workaround for downloading apngs straight from amazon instead of broken ones from cloudflare
+                # there are some emotes that already have amazonaws in their url, so don't replace it again
+                download_url = image_url
+                if "s3.amazonaws.com" not in download_url:
+                    download_url = re.sub(r'^(https?:)?//', 'https://s3.amazonaws.com/', download_url)
 
-        workpool.shutdown()
-        workpool.join()
+                jobs.append(DownloadJob(self._get_session(download_url),
+                                        download_url,
+                                        retry=5,
+                                        rate_limit_lock=rate_limit,
+                                        callback=self._callback_download_image,
+                                        stream=True,
+                                        **{'image_url': image_url}))
 
-    def _process_emotes(self):
-        logger.debug("Processing emotes using {} threads".format(self.workers))
-        workpool = WorkerPool(self.workers)
+        self._start_download_jobs(jobs).join()
+        image_store.save()
 
-        key_func = lambda e: e['background-image']
+    def _process_emotes(self):
+        # one processor per distinct image, however many urls and subreddits it appears under
+        processors = []
+        image_store = self._get_image_store()
+        digests = {}
         with self.mutex:
-            for image_url, group in itertools.groupby(sorted(self.emotes, key=key_func), key_func):
-                if not image_url:
-                    continue
-
-                workpool.put(self.processor_factory.new_processor(scraper=self, image_url=image_url, group=list(group)))
-
-        workpool.shutdown()
-        workpool.join()
+            for emote in self.emotes:
+                image_url = emote['background-image']
+                if image_url and image_url not in digests:
+                    digests[image_url] = image_store.get_digest(image_url)
+
+            # images that didn't download are tried again next time, so their subreddits can't be skipped then
+            self._incomplete_subreddits = set(e['sr'] for e in self.emotes
+                                              if e['sr'] not in self._skipped_subreddits and e.get('background-image')
+                                              and not self.get_image_path(e['background-image']))
+            emotes = sorted((e for e in self.emotes
+                             if digests.get(e['background-image']) and e['sr'] not in self._skipped_subreddits),
+                            key=lambda e: (digests[e['background-image']], e['background-image']))
+            for digest, group in itertools.groupby(emotes, lambda e: digests[e['background-image']]):
+                group = list(group)
+                processors.append(self.processor_factory.new_processor(scraper=self,
+                                                                       image_url=group[0]['background-image'],
+                                                                       group=group))
+
+        if self.image_processes:
+            logger.debug("Processing emotes using {} processes".format(self.image_processes))
+            with ProcessPoolExecutor(self.image_processes) as pool:
+                futures = [pool.submit(process_in_worker, processor) for processor in processors]
+                # merged in submission order, so the results don't depend on which process finishes first
+                for processor, future in zip(processors, futures):
+                    try:
+                        processor.merge_result(future.result())
+                    except Exception as e:
+                        logger.error('Failed to process {}: {}'.format(processor.image_url, e))
+        else:
+            logger.debug("Processing emotes using {} threads".format(self.workers))
+            workpool = WorkerPool(self.workers)
+            for processor in processors:
+                workpool.put(processor)
+            workpool.shutdown()
+            workpool.join()
+
+        for processor in processors:
+            if not processor.completed:
+                self._incomplete_subreddits.update(e['sr'] for e in processor.group)
+        self.processor_factory.finish()
+
+    def get_processor_context(self, image_url):
+        """
+        Stands in for the scraper when a processor for image_url is sent to another process.
+        """
+        return ProcessorContext({image_url: self.get_image_path(image_url)})
 
     def scrape(self):
+        self._retry_budget = RetryBudget(self.retry_budget)
+
         # Login
         if self.user and self.password:
             body = {'user': self.user, 'passwd': self.password, "rem": False}
             self.rate_limit_lock and self.rate_limit_lock.acquire()
-            self._requests.post('https://old.reddit.com/api/login', body)
+            self._get_session(REDDIT_ORIGIN).post(REDDIT_ORIGIN + '/api/login', body)
+
+        self._load_state()
 
         self._fetch_css()
 
         self._dedupe_emotes()
 
+        self._skip_unchanged_subreddits()
+
         self._download_images()
 
         self._process_emotes()
 
+        self._save_state()
+
+        self._log_connection_stats()
+
         logger.info('All Done')
 
     def _parse_css(self, data):
-        cssparser = tinycss.make_parser('page3')
-        css = cssparser.parse_stylesheet(data)
+        if self._parse_pool:
+            return self._parse_pool.submit(parse_css, data).result()
+        return parse_css(data)
+
+    def _get_css_path(self, subreddit):
+        return os.path.sep.join([self.cache_dir, subreddit + '.css'])
 
-        if not css:
+    def _get_validators_path(self, subreddit):
+        return os.path.sep.join([self.cache_dir, subreddit + '.css.validators'])
+
+    def _get_conditional_headers(self, subreddit):
+        # Validators are useless without the css they validate
+        if not os.path.exists(self._get_css_path(subreddit)):
             return None
 
-        re_emote = re.compile(r'a\[href[|^$]?=["\']\/([\w:]+)["\']\](:hover)?(\sem|\sstrong)?')
-        emotes_staging = defaultdict(dict)
-
-        for rule in css.rules:
-            if re_emote.match(rule.selector.as_css()):
-                for match in re_emote.finditer(rule.selector.as_css()):
-                    rules = {}
-
-                    for declaration in rule.declarations:
-                        if match.group(3):
-                            name = match.group(3).strip() + '-' + declaration.name
-                            rules[name] = declaration.value.as_css()
-                            emotes_staging[match.group(1)].update(rules)
-                        elif declaration.name in ['text-align',
-                                                  'line-height',
-                                                  'color'] or declaration.name.startswith('font') or declaration.name.startswith('text'):
-                            name = 'text-' + declaration.name
-                            rules[name] = declaration.value.as_css()
-                            emotes_staging[match.group(1)].update(rules)
-                        elif declaration.name in ['width',
-                                                   'height',
-                                                   'background-image',
-                                                   'background-position',
-                                                   'background', ]:
-                            name = declaration.name
-                            if name == 'background-position':
-                                val = ['{}{}'.format(v.value, v.unit if v.unit else '') for v in declaration.value if
-                                       v.value != ' ']
-                            else:
-                                val = declaration.value[0].value
-                            if match.group(2):
-                                name = 'hover-' + name
-                            rules[name] = val
-                            emotes_staging[match.group(1)].update(rules)
-        return emotes_staging
+        try:
+            with open(self._get_validators_path(subreddit), 'r', encoding='utf8') as validators_file:
+                validators = json.load(validators_file)
+        except (IOError, ValueError):
+            return None
+
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last-modified'):
+            headers['If-Modified-Since'] = validators['last-modified']
+        return headers or None
+
+    def _save_validators(self, subreddit, response_headers):
+        validators = {'etag': response_headers.get('ETag'),
+                      'last-modified': response_headers.get('Last-Modified')}
+        validators_path = self._get_validators_path(subreddit)
+        if not validators['etag'] and not validators['last-modified']:
+            if os.path.exists(validators_path):
+                os.remove(validators_path)
+            return
+
+        with open(validators_path, 'w', encoding='utf8') as validators_file:
+            json.dump(validators, validators_file)
 
     def _callback_fetch_stylesheet(self, response, subreddit=None):
         if not subreddit:
@@ -235,8 +550,10 @@ class BMScraper(FileNameUtils):
         if response is not None:
             self._process_stylesheet_response(response.status_code,
                                               response.text,
-                                              response.headers['Content-Type'],
+                                              response.headers.get('Content-Type'),
                                               subreddit)
+            if response.status_code == 200 and response.headers.get('Content-Type') == "text/css":
+                self._save_validators(subreddit, response.headers)
         else:
             logger.error("Failed to get response when fetching css for {}".format(subreddit))
             self._process_stylesheet_response(None,
@@ -251,12 +568,14 @@ class BMScraper(FileNameUtils):
 
         css = ''
 
-        css_path = os.path.sep.join([self.cache_dir, subreddit + '.css'])
+        css_path = self._get_css_path(subreddit)
         if os.path.exists(css_path):
             with open(css_path, 'r', encoding='utf8') as css_file:
                 css = css_file.read()
 
-        if status_code != 200:
+        if status_code == 304:
+            logger.debug('Css for {} not modified'.format(subreddit))
+        elif status_code != 200:
             logger.error("Failed to fetch css for {} (Status {})".format(subreddit, status_code))
         elif content_type != "text/css":
             logger.error("Got something that wasn't css for {} (Context-Type {})".format(subreddit, content_type))
@@ -270,41 +589,66 @@ class BMScraper(FileNameUtils):
             logger.error("No css for {} found".format(subreddit))
             return
 
-        emotes_staging = self._parse_css(css)
+        css_digest = hashlib.sha1(css.encode('utf-8')).hexdigest()
+        self._process_css(subreddit, css_digest, lambda: self._parse_css(css))
+
+    def _process_css(self, subreddit, css_digest, parse):
+        """
+        Adds the emotes of a stylesheet, parse() is only called if last run's can't be reused.
+        """
+        previous = self._state.get(subreddit)
+        if (previous and previous['css'] == css_digest
+                and previous['config'] == self._get_config_digest(subreddit, previous['names'])):
+            logger.debug('Css for {} unchanged since the last run'.format(subreddit))
+            with self.mutex:
+                self.emotes.extend(copy.deepcopy(previous['parsed']))
+                self._unchanged_subreddits.add(subreddit)
+                self._new_state[subreddit] = previous
+            return
+
+        emotes_staging = parse()
         if not emotes_staging:
             return
 
-        #group the emotes based on their css rule content
-        for emote, group in itertools.groupby(sorted(emotes_staging.items(), key=lambda e: str(e[1])), lambda e: e[1]):
-            emote['names'] = [a[0] for a in group]
-            
+        emotes = self._process_emotes_staging(emotes_staging, subreddit)
+        with self.mutex:
+            self.emotes.extend(emotes)
+            if self.incremental:
+                self._new_state[subreddit] = {
+                    'css': css_digest,
+                    'names': list(emotes_staging.keys()),
+                    'config': self._get_config_digest(subreddit, emotes_staging.keys()),
+                    'parsed': copy.deepcopy(emotes),
+                }
+
+    def _process_emotes_staging(self, emotes_staging, subreddit):
+        emotes = []
+
+        # group the emotes based on their css rule content, the fingerprint stays on the emote
+        groups = {}
+        for name, rules in emotes_staging.items():
+            fingerprint = rule_fingerprint(rules)
+            if fingerprint not in groups:
+                rules['fingerprint'] = fingerprint
+                rules['names'] = []
+                groups[fingerprint] = rules
+            groups[fingerprint]['names'].append(name)
+
+        for emote in groups.values():
             if 'tags' not in emote:
                 emote['tags'] = []
             for name in emote['names']:
-                meta_data = next((x for x in self.emote_info if x['name'] == name), None)
+                meta_data = self._emote_info_index.get(name)
 
                 if meta_data:
-                    for key, val in meta_data.items():
+                    for key, val in meta_data[0][1].items():
                         if key != 'name':
                             emote[key] = val
 
-                tag_data = None
-                if name in self.tags_data:
-                    tag_data = self.tags_data[name]
-
-                if tag_data:
-                    if 'tags' not in emote:
-                        emote['tags'] = []
-                    logger.debug('Tagging: {} with {}'.format(name, tag_data))
-                    emote['tags'].extend(k for k, v in tag_data['tags'].items() if v['score'] >= 1)
-                    if tag_data.get('specialTags'):
-                        emote['tags'].extend(tag_data['specialTags'])
-
-                    if 'added_date' in tag_data:
-                        added_date = parser.parse(tag_data['added_date'])
-                        now = datetime.now(tzutc())
-                        if now - added_date < timedelta(days=7):
-                            emote['tags'].append('new')
+                emote_tags = self._emote_tags.get(name)
+                if emote_tags:
+                    logger.debug('Tagging: {} with {}'.format(name, self.tags_data[name]))
+                    emote['tags'].extend(emote_tags[0])
 
             if subreddit in self.nsfw_subreddits:
                 emote['nsfw'] = True
@@ -313,45 +657,172 @@ class BMScraper(FileNameUtils):
 
             # Sometimes people make css errors, fix those.
             if 'background-image' not in emote and 'background' in emote:
-                if re.match(r'^(https?:)?//', emote['background']):
+                if _SCHEME_PREFIX.match(emote['background']):
                     emote['background-image'] = emote['background']
                     del emote['background']
 
             # need at least an image for a ponymote. Some trash was getting in.
             # 1500 pixels should be enough for anyone!
             if ('background-image' in emote
-                and re.sub(r'^(https?:)?//', '', emote['background-image']) not in self.image_blacklist
+                and _SCHEME_PREFIX.sub('', emote['background-image']) not in self._image_blacklist
                 and 'height' in emote and emote['height'] < 1500
                 and 'width' in emote and emote['width'] < 1500):
-                with self.mutex:
-                    self.emotes.append(emote)
+                emotes.append(emote)
             else:
                 logger.warn('Discarding emotes {}'.format(emote['names'][0]))
 
-    def _callback_download_image(self, response, image_path=None):
-        if not image_path:
-            logger.error("image_path not set")
+        return emotes
+
+    def _get_config_digest(self, subreddit, names):
+        """
+        Digest of everything besides the css that _process_emotes_staging() looks at for these emotes.
+        """
+        names = set(names)
+        tags_data = {}
+        emote_info = []
+        for name in sorted(names):
+            if name in self._emote_tags:
+                tags_data[name] = [self.tags_data[name], self._emote_tags[name][1]]
+            emote_info.extend(self._emote_info_index.get(name, []))
+
+        config = [subreddit in self.nsfw_subreddits,
+                  self._sorted_image_blacklist,
+                  [info for i, info in sorted(emote_info, key=itemgetter(0))],
+                  tags_data]
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_state_path(self):
+        return os.path.join(self.cache_dir, 'scrape_state.json')
+
+    def _load_state(self):
+        self._state = {}
+        self._new_state = {}
+        self._unchanged_subreddits = set()
+        self._skipped_subreddits = set()
+        self._incomplete_subreddits = set()
+        if not self.incremental or not os.path.exists(self._get_state_path()):
             return
 
-        if not response:
-            logger.error("Failed to fetch image {}".format(image_path))
+        try:
+            with open(self._get_state_path(), 'r', encoding='utf8') as state_file:
+                state = json.load(state_file)
+            if state.get('version') == SCRAPE_STATE_VERSION:
+                self._state = state['subreddits']
+            else:
+                logger.info("Scrape state {} is from another version, doing a full scrape".format(self._get_state_path()))
+        except (ValueError, KeyError):
+            logger.error("Scrape state {} is broken, doing a full scrape".format(self._get_state_path()))
+
+    def _skip_unchanged_subreddits(self):
+        """
+        Swaps in last run's processed emotes for unchanged subreddits that dedupe left alone as well.
+        """
+        if not self.incremental:
             return
 
-        if response.status_code != 200:
-            logger.error("Failed to fetch image {} (Status {})".format(image_path, response.status_code))
+        with self.mutex:
+            subreddit_emotes = defaultdict(list)
+            for emote in self.emotes:
+                subreddit_emotes[emote['sr']].append(emote)
+
+            for subreddit in self._unchanged_subreddits:
+                previous = self._state[subreddit]
+                if 'processed' in previous and previous['deduped'] == subreddit_emotes[subreddit]:
+                    self._skipped_subreddits.add(subreddit)
+                    subreddit_emotes[subreddit] = copy.deepcopy(previous['processed'])
+                    self.processor_factory.restore_state(subreddit, previous['processor'])
+
+            logger.info('Skipping {} unchanged subreddits'.format(len(self._skipped_subreddits)))
+
+            emotes = []
+            for emote in self.emotes:
+                if emote['sr'] not in self._skipped_subreddits:
+                    emotes.append(emote)
+                elif subreddit_emotes[emote['sr']] is not None:
+                    emotes.extend(subreddit_emotes[emote['sr']])
+                    subreddit_emotes[emote['sr']] = None
+            self.emotes = emotes
+
+            for subreddit, state in self._new_state.items():
+                if subreddit not in self._skipped_subreddits:
+                    state['deduped'] = copy.deepcopy(subreddit_emotes[subreddit])
+
+    def _save_state(self):
+        if not self.incremental:
+            return
+
+        with self.mutex:
+            subreddit_emotes = defaultdict(list)
+            for emote in self.emotes:
+                subreddit_emotes[emote['sr']].append(emote)
+
+            for subreddit, state in self._new_state.items():
+                if subreddit in self._incomplete_subreddits:
+                    # an unchanged subreddit carries last run's, which may be from another dedupe
+                    logger.info('Not keeping {} for the next scrape, some of its emotes failed'.format(subreddit))
+                    state.pop('processed', None)
+                    state.pop('processor', None)
+                elif subreddit not in self._skipped_subreddits:
+                    state['processed'] = subreddit_emotes[subreddit]
+                    state['processor'] = self.processor_factory.get_state(subreddit)
+
+            state_path = self._get_state_path()
+            with open(state_path + '.tmp', 'w', encoding='utf8') as state_file:
+                json.dump({'version': SCRAPE_STATE_VERSION, 'subreddits': self._new_state},
+                          state_file, separators=(',', ':'))
+            os.replace(state_path + '.tmp', state_path)
+
+    def _callback_download_image(self, response, image_url=None):
+        if not image_url:
+            logger.error("image_url not set")
             return
 
-        data = response.content
-        if not data or len(data) == 0:
-            logger.error("Failed to fetch image {}, data is empty".format(image_path))
+        if not response:
+            logger.error("Failed to fetch image {}".format(image_url))
             return
 
-        image_dir = os.path.dirname(image_path)
-        if not os.path.exists(image_dir):
+        if response.status_code != 200:
+            logger.error("Failed to fetch image {} (Status {})".format(image_url, response.status_code))
+            return
+
+        content_length = None
+        if response.headers.get('Content-Encoding', 'identity') == 'identity':
             try:
-                os.makedirs(image_dir)
-            except OSError:
+                content_length = int(response.headers['Content-Length'])
+            except (KeyError, ValueError):
                 pass
 
-        with open(image_path, 'wb') as f:
-            f.write(data)
+        if self.max_image_size and content_length and content_length > self.max_image_size:
+            logger.error("Not fetching image {}, {} bytes is over the size limit".format(image_url, content_length))
+            return
+
+        # Stream into a temporary file and only add it to the store once complete, so an
+        # interrupted download never leaves a truncated image behind for _download_images to trust
+        image_store = self._get_image_store()
+        sha1 = hashlib.sha1()
+        size = 0
+        fd, temp_path = image_store.new_temp_file()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+                    size += len(chunk)
+                    if self.max_image_size and size > self.max_image_size:
+                        logger.error("Failed to fetch image {}, over the size limit of {} bytes".format(
+                            image_url, self.max_image_size))
+                        return
+                    sha1.update(chunk)
+                    f.write(chunk)
+
+            if size == 0:
+                logger.error("Failed to fetch image {}, data is empty".format(image_url))
+                return
+
+            if content_length is not None and size != content_length:
+                logger.error("Failed to fetch image {}, got {} of {} bytes".format(image_url, size, content_length))
+                return
+
+            image_store.add(image_url, temp_path, sha1.hexdigest())
+            temp_path = None
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
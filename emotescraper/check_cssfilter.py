@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# Checks that extract_emote_rules() doesn't change what parse_css() finds, by parsing every
+# stylesheet filtered and unfiltered. The filter is built from tinycss internals, so run this
+# after upgrading tinycss:
+#
+# check_cssfilter.py [css files], the legacy css by default
+import os
+import sys
+import glob
+
+from bmscraper.scraper import parse_css
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'legacy_css', '*.css')))
+    failed = []
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as fh:
+            css = fh.read()
+        if parse_css(css) != parse_css(css, filtered=False):
+            failed.append(path)
+            print('Filtering changes the emotes of {}'.format(path))
+
+    print('{} of {} stylesheets parse the same filtered'.format(len(paths) - len(failed), len(paths)))
+    sys.exit(1 if failed else 0)
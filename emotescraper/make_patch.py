@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Patches between successive releases of berrymotes_json_data.json, so clients that have the
+# previous release don't need to download everything again. A release's version is the sha1 of
+# its file. The manifest lists the latest version and the patches leading up to it:
+#
+# {"version": latest version,
+#  "patches": [{"from": version, "to": version, "file": path relative to the manifest}, ...]}
+#
+# A patch is {"from": version, "to": version,
+#             "removed": [emote keys], "changed": [emotes], "added": [[index, emote], ...]}
+# and emotes are identified by subreddit and longest name, the name of their single emote file.
+import os
+import json
+import hashlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# how many releases back clients can catch up with patches
+PATCH_HISTORY = 20
+
+
+def emote_key(emote):
+    return '{}/{}'.format(emote['sr'], max(emote['names'], key=len))
+
+
+def load_release(fname):
+    """
+    (version, emotes) of a released data file, None if there is none.
+    """
+    try:
+        with open(fname, 'rb') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return None
+    return hashlib.sha1(data).hexdigest(), json.loads(data.decode('utf-8'))
+
+
+def make_patch(old_version, old, version, new):
+    """
+    The patch from old to new, None if there can't be one because emote keys aren't unique or
+    emotes that are in both changed order.
+    """
+    old_emotes = dict((emote_key(e), e) for e in old)
+    new_emotes = dict((emote_key(e), e) for e in new)
+    if len(old_emotes) != len(old) or len(new_emotes) != len(new):
+        return None
+
+    if ([k for k in old_emotes if k in new_emotes] != [k for k in new_emotes if k in old_emotes]):
+        return None
+
+    return {'from': old_version,
+            'to': version,
+            'removed': [k for k in old_emotes if k not in new_emotes],
+            'changed': [e for k, e in new_emotes.items() if k in old_emotes and old_emotes[k] != e],
+            'added': [[i, e] for i, (k, e) in enumerate(new_emotes.items()) if k not in old_emotes]}
+
+
+def apply_patch(old, patch):
+    removed = set(patch['removed'])
+    changed = dict((emote_key(e), e) for e in patch['changed'])
+    emotes = [changed.get(emote_key(e), e) for e in old if emote_key(e) not in removed]
+    for i, emote in patch['added']:
+        emotes.insert(i, emote)
+    return emotes
+
+
+def publish(data_dir, previous, version, emotes, writer, manifest_name='berrymotes_patches.json'):
+    """
+    Adds the patch from the previous release (load_release() before it was overwritten) to
+    version to the manifest and writes both through an OutputWriter. Returns the files of the
+    patches that dropped out of the manifest, for remove_dropped() once the writer finished.
+    """
+    if previous and previous[0] == version:
+        return []
+
+    manifest_path = os.path.join(data_dir, manifest_name)
+    try:
+        with open(manifest_path, 'rb') as fh:
+            manifest = json.loads(fh.read().decode('utf-8'))
+    except (FileNotFoundError, ValueError):
+        manifest = {'version': None, 'patches': []}
+
+    # a chain of patches only leads somewhere if it ends in the release before this one
+    patches = list(manifest['patches']) if previous and manifest['version'] == previous[0] else []
+    patch = previous and make_patch(previous[0], previous[1], version, emotes)
+    if patch and apply_patch(previous[1], patch) == emotes:
+        patch_file = 'patches/{}-{}.json'.format(previous[0], version)
+        with writer.open(os.path.join(data_dir, patch_file)) as fh:
+            fh.write(json.dumps(patch, separators=(',', ':')).encode('utf-8'))
+        patches.append({'from': previous[0], 'to': version, 'file': patch_file})
+    else:
+        logger.info('No patch to release {}, clients need the full data'.format(version))
+        patches = []
+    patches = patches[-PATCH_HISTORY:]
+
+    with writer.open(manifest_path) as fh:
+        fh.write(json.dumps({'version': version, 'patches': patches}, separators=(',', ':')).encode('utf-8'))
+
+    # the live manifest still lists them until the writer replaces it
+    return [os.path.join(data_dir, dropped['file'] + suffix)
+            for dropped in manifest['patches'] if dropped not in patches
+            for suffix in ('', '.gz', '.br')]
+
+
+def remove_dropped(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    import sys
+
+    # make_patch.py old.json new.json prints the patch between two releases
+    old_version, old = load_release(sys.argv[1])
+    version, new = load_release(sys.argv[2])
+    print(json.dumps(make_patch(old_version, old, version, new), separators=(',', ':')))
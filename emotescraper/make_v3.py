@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Columnar version of the v2 emote data. Every key of the emotes becomes a column:
+#
+# {"version": 3,
+#  "count": number of emotes,
+#  "ids": "index" when every emote's id is its position, the ids are a column otherwise,
+#  "strings": string table, most used first,
+#  "columns": [{"key": emote key,
+#               "type": "s" string table reference, "S" list of string table references,
+#                       "j" the values as they are,
+#               "values": one per emote that has the key,
+#               "rows": missing if every emote has the key, otherwise the emotes that have it
+#                       as differences to the previous one}]}
+import os
+import json
+from collections import Counter
+
+import make_v2
+
+VERSION = 3
+
+
+def _is_strings(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def _column_type(values):
+    # strings go into the table when they repeat enough to be worth a reference
+    if all(isinstance(v, str) for v in values):
+        strings = values
+        column_type = 's'
+    elif all(_is_strings(v) for v in values):
+        strings = [s for v in values for s in v]
+        column_type = 'S'
+    else:
+        return 'j'
+    if len(set(strings)) * 2 > len(strings):
+        return 'j'
+    return column_type
+
+
+def from_data(emotes):
+    keys = []
+    for emote in emotes:
+        for key in emote:
+            if key not in keys:
+                keys.append(key)
+
+    data = {'version': VERSION, 'count': len(emotes)}
+    if 'id' in keys and all(emote.get('id') == i for i, emote in enumerate(emotes)):
+        data['ids'] = 'index'
+        keys.remove('id')
+
+    columns = []
+    for key in keys:
+        rows = [i for i, emote in enumerate(emotes) if key in emote]
+        values = [emotes[i][key] for i in rows]
+        column = {'key': key, 'type': _column_type(values), 'values': values}
+        if len(rows) != len(emotes):
+            column['rows'] = [row - previous for row, previous in zip(rows, [0] + rows)]
+        columns.append(column)
+
+    counts = Counter()
+    for column in columns:
+        if column['type'] == 's':
+            counts.update(column['values'])
+        elif column['type'] == 'S':
+            counts.update(s for v in column['values'] for s in v)
+    strings = [s for s, count in sorted(counts.items(), key=lambda c: (-c[1], c[0]))]
+    refs = dict((s, i) for i, s in enumerate(strings))
+
+    for column in columns:
+        if column['type'] == 's':
+            column['values'] = [refs[v] for v in column['values']]
+        elif column['type'] == 'S':
+            column['values'] = [[refs[s] for s in v] for v in column['values']]
+
+    data['strings'] = strings
+    data['columns'] = columns
+    return data
+
+
+def to_data(data):
+    if data.get('version') != VERSION:
+        raise ValueError('Not v{} emote data'.format(VERSION))
+
+    emotes = [{} for i in range(data['count'])]
+    if data.get('ids') == 'index':
+        for i, emote in enumerate(emotes):
+            emote['id'] = i
+
+    strings = data['strings']
+    for column in data['columns']:
+        values = column['values']
+        if column['type'] == 's':
+            values = [strings[v] for v in values]
+        elif column['type'] == 'S':
+            values = [[strings[s] for s in v] for v in values]
+
+        if 'rows' in column:
+            rows = []
+            row = 0
+            for delta in column['rows']:
+                row += delta
+                rows.append(row)
+        else:
+            rows = range(len(emotes))
+
+        for row, value in zip(rows, values):
+            emotes[row][column['key']] = value
+    return emotes
+
+
+def from_file(fname):
+    with open(fname, 'rb') as fh:
+        return to_data(json.load(fh))
+
+
+# emote lists the format has to get through unchanged, whatever the deployed data looks like
+CHECK_DATA = [
+    [],
+    [{'id': 0, 'names': ['a'], 'sr': 'mylittlepony'}],
+    [{'id': 0, 'names': ['a', 'b'], 'sr': 'mlp', 'tags': ['new'], 'width': 70, 'height': 70},
+     {'id': 1, 'names': ['c'], 'sr': 'mlp', 'nsfw': True, 'background-position': ['-70px', '0px']},
+     {'id': 2, 'names': ['d'], 'sr': 'mlp', 'tags': [], 'width': 70, 'height': 70, 'apng_url': 'x.png'},
+     {'id': 3, 'names': ['e'], 'sr': 'other', 'tags': ['new'], 'hover-width': 70, 'text': None}],
+    [{'id': 5, 'names': ['a'], 'sr': 'mlp'}, {'names': ['b'], 'sr': 'mlp'}, {'id': 'x', 'sr': 'mlp'}],
+    [{}, {'sr': 'mlp'}, {}],
+]
+
+
+def check():
+    for emotes in CHECK_DATA:
+        assert to_data(json.loads(json.dumps(from_data(emotes)))) == emotes, 'v3 round trip lost data of {}'.format(emotes)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # make_v3.py check round-trips CHECK_DATA without touching ../data
+    check()
+    if sys.argv[1:] == ['check']:
+        sys.exit(0)
+
+    data = make_v2.from_file(os.path.join('..', 'data', 'berrymotes_json_data.json'))
+    v3 = from_data(data)
+
+    # the v3 file has to hold exactly what the v2 one does
+    assert to_data(json.loads(json.dumps(v3))) == data, 'v3 round trip lost data'
+
+    with open(os.path.join('..', 'data', 'berrymotes_json_data.v3.json'), 'wb') as fh:
+        fh.write(json.dumps(v3, separators=(',', ':')).encode('utf-8'))
@@ -16,20 +16,16 @@
 import logging
 import time
 import requests
-import gzip
-from bmscraper.ratelimiter import TokenBucket
+from bmscraper.ratelimiter import AdaptiveRateLimiter
+from bmscraper.outputwriter import OutputWriter, json_chunks
 import make_v2
+import make_v3
+import make_patch
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 from bmscraper import BMScraper, UserscriptEmotesProcessorFactory
 
-try:
-    import brotli
-except ImportError:
-    logger.warn('Brotli is not available')
-    brotli = None
-
 from data import *
 from json import dumps
 import os
@@ -38,7 +34,8 @@ CDN_ORIGIN = 'https://berrytube.tv/berrymotes'
 
 factory = UserscriptEmotesProcessorFactory(single_emotes_filename=os.path.join('..', 'single_emotes', '{}', '{}.png'),
                                            apng_dir=os.path.join('..', 'images'),
-                                           apng_url=CDN_ORIGIN + '/images/{}/{}')
+                                           apng_url=CDN_ORIGIN + '/images/{}/{}',
+                                           encoder_profile=os.environ.get('EMOTE_ENCODER_PROFILE'))
 
 scraper = BMScraper(factory)
 scraper.user = os.environ['REDDIT_USERNAME']
@@ -48,44 +45,42 @@ scraper.legacy_subreddits = legacy_subreddits
 scraper.image_blacklist = image_blacklist
 scraper.nsfw_subreddits = nsfw_subreddits
 scraper.emote_info = emote_info
+scraper.incremental = True
 
-#these values seem to be quite stable (occasional 429 does happen though, because nothing makes sense)
-scraper.rate_limit_lock = TokenBucket(1, 6)
+# start at the rate that used to be stable and let Reddit's rate limit headers move it from there
+scraper.rate_limit_lock = AdaptiveRateLimiter(1, 6)
 scraper.tags_data = requests.get(CDN_ORIGIN + "/data/tags.js").json()
 
 start = time.time()
 scraper.scrape()
 logger.info("Finished scrape in {}.".format(time.time() - start))
 
-def output(basename, data):
-    with open(basename, 'wb') as fh:
-        fh.write(data.encode('utf-8'))
+# the rule fingerprint is only of use to the scraper itself
+for emote in scraper.emotes:
+    emote.pop('fingerprint', None)
+
+# the emotes are encoded one at a time, straight into the files, make_v2 changes them so it goes last
+writer = OutputWriter()
+json_path = os.path.join('..', 'data', 'berrymotes_json_data.json')
+previous_release = make_patch.load_release(json_path)
+with writer.open(os.path.join('..', 'data', 'berrymotes_data.js')) as js_file, \
+        writer.open(json_path) as json_file:
+    js_file.write(b"var berryEmotes=")
+    for chunk in json_chunks(scraper.emotes):
+        js_file.write(chunk)
+        json_file.write(chunk)
+    js_file.write(b";")
 
-    fname = basename + '.gz'
-    try:
-        with gzip.open(fname, 'wb') as fh:
-            fh.write(data.encode('utf-8'))
-    except:
-        logger.exception('Unable to gzip emote data')
-        try:
-            os.unlink(fname)
-        except FileNotFoundError:
-            pass
+dropped_patches = make_patch.publish(os.path.join('..', 'data'), previous_release, json_file.digest, scraper.emotes, writer)
 
-    if brotli:
-        fname = basename + '.br'
-        try:
-            with open(fname, 'wb') as fh:
-                fh.write(brotli.compress(data, brotli.MODE_TEXT))
-        except:
-            logger.exception('Unable to brotli emote data')
-            try:
-                os.unlink(fname)
-            except FileNotFoundError:
-                pass
+with writer.open(os.path.join('..', 'data', 'berrymotes_json_data.v2.json')) as v2_file:
+    for chunk in json_chunks(make_v2.from_data(scraper.emotes)):
+        v2_file.write(chunk)
 
-json = dumps(scraper.emotes, separators=(',', ':'))
+# columnar, built from the v2 emotes
+with writer.open(os.path.join('..', 'data', 'berrymotes_json_data.v3.json')) as v3_file:
+    v3_file.write(dumps(make_v3.from_data(scraper.emotes), separators=(',', ':')).encode('utf-8'))
 
-output(os.path.join('..', 'data', 'berrymotes_data.js'), ''.join(["var berryEmotes=", json, ";"]))
-output(os.path.join('..', 'data', 'berrymotes_json_data.json'), json)
-output(os.path.join('..', 'data', 'berrymotes_json_data.v2.json'), dumps(make_v2.from_data(scraper.emotes), separators=(',', ':')))
+written = writer.finish()
+make_patch.remove_dropped(dropped_patches)
+logger.info('Wrote {} of the output files, the others are unchanged'.format(len(written)))